@@ -1,6 +1,15 @@
+import numpy as np
+from PortfolioState import TransactionMode
+
 #
 # ToDo: Implement me! Here is where you create your trading algorithm...
 #
+# The scalar functions below are the reference implementation. evaluatePortfolio
+# is what MainStockWatcher calls, once per refresh, with the whole portfolio as
+# arrays. If you change one, change the other, and run
+# >> python3 -m pytest test_PortfolioState.py
+# to check that they still agree.
+#
 
 def howManyToBuy(tickerName, totalStockValue, singleStockPriceSek, singleStockPriceOrigCurr, bougthAtOrigiCurr, soldAtOrigCurr, switchedAt, transactionMode: TransactionMode):
     # Return the number of stocks to buy
@@ -17,5 +26,18 @@ def howManyToSell(tickerName, totalStockValue, singleStockPriceSek, singleStockP
 # ...
 # #########################################################################
 def getBuyIndication(stockValueTot, investedTot):
-    # ... 
-    return 0.0    
+    # ...
+    return 0.0
+
+# #########################################################################
+# The whole portfolio at once. Every argument is an array with one element
+# per ticker (tickerNames may be any sequence), transactionModes holds
+# TransactionMode values as integers. Returns the arrays
+# (numberToBuy, numberToSell, buyIndication).
+# #########################################################################
+def evaluatePortfolio(tickerNames, totalStockValues, singleStockPricesSek, singleStockPricesOrigCurr, bougthAtOrigiCurr, soldAtOrigCurr, switchedAt, transactionModes, investedTot):
+    tickerCount = len(tickerNames)
+    numberToBuy = np.zeros(tickerCount, dtype=np.int64)
+    numberToSell = np.zeros(tickerCount, dtype=np.int64)
+    buyIndication = np.zeros(tickerCount, dtype=np.float64)
+    return numberToBuy, numberToSell, buyIndication
@@ -0,0 +1,242 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import tempfile
+import concurrent.futures
+import numpy as np
+import Analyze
+import PriceHistory
+import PortfolioState
+
+#
+# Replays price series through the strategy in Analyze, the way MainStockWatcher
+# does on every refresh, and applies the trades the way a client would post them
+# to /tradingpal/updateStock. Strategy variants are run in parallel processes.
+# >> python3 Backtest.py --history /history --sweep variants.json
+#
+
+DEFAULT_START_VALUE_SEK = 10000
+
+def loadPriceHistory(directory, tickers=None):
+    """
+    Reads recorded prices from a PriceHistory directory. Returns
+    ticker -> (timestamps, prices, pricesSek).
+    """
+    history = PriceHistory.PriceHistory(directory)
+    if tickers is None:
+        tickers = history.tickers()
+
+    series = {}
+    for ticker in tickers:
+        records = history.records(ticker)
+        if len(records) > 0:
+            series[ticker] = (np.array(records["timestamp"]), np.array(records["price"]), np.array(records["price_in_sek"]))
+
+    return series
+
+def loadCsv(path):
+    """
+    Reads prices from a csv file with the columns timestamp, ticker, price and
+    optionally price_in_sek (defaults to price). Returns the same as loadPriceHistory.
+    """
+    rows = {}
+    with open(path, newline='') as csvFile:
+        for row in csv.DictReader(csvFile):
+            price = float(row["price"])
+            priceSek = float(row["price_in_sek"]) if row.get("price_in_sek") else price
+            rows.setdefault(row["ticker"], []).append((float(row["timestamp"]), price, priceSek))
+
+    series = {}
+    for ticker, tickerRows in rows.items():
+        tickerRows.sort()
+        timestamps, prices, pricesSek = (np.array(column) for column in zip(*tickerRows))
+        series[ticker] = (timestamps, prices, pricesSek)
+
+    return series
+
+def alignSeries(series):
+    """
+    Puts all tickers on one time axis, the union of all timestamps. Every ticker
+    keeps its last known price until it gets a new one, and is NaN before its first.
+    Returns (tickers, timestamps, prices, pricesSek), the price matrices are time x ticker.
+    """
+    tickers = sorted(series.keys())
+    timestamps = np.unique(np.concatenate([series[ticker][0] for ticker in tickers]))
+    prices = np.full((len(timestamps), len(tickers)), np.nan)
+    pricesSek = np.full((len(timestamps), len(tickers)), np.nan)
+
+    for column, ticker in enumerate(tickers):
+        tickerTimestamps, tickerPrices, tickerPricesSek = series[ticker]
+        last = np.searchsorted(tickerTimestamps, timestamps, side='right') - 1
+        known = last >= 0
+        prices[known, column] = tickerPrices[last[known]]
+        pricesSek[known, column] = tickerPricesSek[last[known]]
+
+    return tickers, timestamps, prices, pricesSek
+
+def _stateInputs(stockData, singleStockPriceSek):
+    # The parts of PortfolioState.tradingInputs that only change when the ticker trades
+    _, boughtAt, soldAt, switchedAt, transactionMode, _ = PortfolioState.tradingInputs(stockData, singleStockPriceSek)
+    return [np.nan if value is None else value for value in (boughtAt, soldAt, switchedAt)] + [int(transactionMode)]
+
+def runVariant(tickers, timestamps, prices, pricesSek, initialPortfolio=None, variant=None):
+    """
+    Runs one strategy variant over the aligned series. variant overrides module
+    level names in Analyze, i.e. {"BUY_THRESHOLD": 0.05}. initialPortfolio maps
+    tickers to asset entries (count, boughtAt, soldAt, switchedAt, totalInvestedSek),
+    tickers without one start in neutral mode with DEFAULT_START_VALUE_SEK worth
+    of stock at their first price.
+    """
+    variant = variant if variant is not None else {}
+    for name in variant:
+        if not hasattr(Analyze, name):
+            raise ValueError(f"Analyze has no {name} to override")
+
+    # Sweep workers run many variants, so the overrides must not outlive this one
+    originals = {name: getattr(Analyze, name) for name in variant}
+    try:
+        for name, value in variant.items():
+            setattr(Analyze, name, value)
+        return _runVariant(tickers, timestamps, prices, pricesSek, initialPortfolio, variant)
+    finally:
+        for name, value in originals.items():
+            setattr(Analyze, name, value)
+
+def _runVariant(tickers, timestamps, prices, pricesSek, initialPortfolio, variant):
+
+    startTime = time.perf_counter()
+    tickerCount = len(tickers)
+    firstKnown = np.argmax(~np.isnan(pricesSek), axis=0)
+    stocks = []
+
+    for column, ticker in enumerate(tickers):
+        if initialPortfolio is not None and ticker in initialPortfolio:
+            stocks.append(dict(initialPortfolio[ticker]))
+        else:
+            count = max(1, int(DEFAULT_START_VALUE_SEK // pricesSek[firstKnown[column], column]))
+            stocks.append({"count": count, "boughtAt": None, "soldAt": None,
+                           "totalInvestedSek": int(count * pricesSek[firstKnown[column], column])})
+
+    counts = np.array([stockData["count"] for stockData in stocks], dtype=np.float64)
+    invested = np.array([stockData["totalInvestedSek"] for stockData in stocks], dtype=np.float64)
+    state = np.array([_stateInputs(stockData, 0) for stockData in stocks], dtype=np.float64).reshape(tickerCount, 4)
+
+    startValueSek = np.nansum(counts * pricesSek[firstKnown, np.arange(tickerCount)])
+    cashSek = 0.0
+    turnoverSek = 0.0
+    trades = 0
+
+    for step in range(len(timestamps)):
+        known = ~np.isnan(pricesSek[step])
+        stepPricesSek = np.where(known, pricesSek[step], 0)
+        valueSek = np.floor(stepPricesSek * counts)
+
+        numberToBuy, numberToSell, _ = PortfolioState.evaluatePortfolio(tickers, valueSek, stepPricesSek, prices[step],
+                                                                 state[:, 0], state[:, 1], state[:, 2], state[:, 3].astype(np.int64), invested)
+
+        # Like MainStockWatcher, only tickers we hold are listed. A ticker listed to
+        # both sell and buy is sold.
+        selling = known & (counts > 0) & (numberToSell > 0)
+        buying = known & (counts > 0) & (numberToBuy > 0) & ~selling
+
+        for column in np.flatnonzero(selling | buying):
+            stockData = stocks[column]
+            if selling[column]:
+                tradeCount = min(int(numberToSell[column]), stockData["count"])
+                tradeSek = tradeCount * pricesSek[step, column]
+                stockData["count"] -= tradeCount
+                stockData["totalInvestedSek"] -= int(tradeSek)
+                cashSek += tradeSek
+                PortfolioState.updateTradeValue(stockData, "boughtAt", None)
+                PortfolioState.updateTradeValue(stockData, "soldAt", prices[step, column])
+            else:
+                tradeCount = int(numberToBuy[column])
+                tradeSek = tradeCount * pricesSek[step, column]
+                stockData["count"] += tradeCount
+                stockData["totalInvestedSek"] += int(tradeSek)
+                cashSek -= tradeSek
+                PortfolioState.updateTradeValue(stockData, "boughtAt", prices[step, column])
+                PortfolioState.updateTradeValue(stockData, "soldAt", None)
+
+            trades += 1
+            turnoverSek += tradeSek
+            counts[column] = stockData["count"]
+            invested[column] = stockData["totalInvestedSek"]
+            state[column] = _stateInputs(stockData, pricesSek[step, column])
+
+    lastKnown = len(timestamps) - 1 - np.argmax(~np.isnan(pricesSek[::-1]), axis=0)
+    endValueSek = np.nansum(counts * pricesSek[lastKnown, np.arange(tickerCount)])
+
+    return {
+        "variant": variant,
+        "tickers": tickerCount,
+        "steps": len(timestamps),
+        "trades": trades,
+        "turnoverSek": round(float(turnoverSek), 2),
+        "pnlSek": round(float(endValueSek + cashSek - startValueSek), 2),
+        "runtimeSec": round(time.perf_counter() - startTime, 3)
+    }
+
+# The aligned series of the sweep this worker process runs variants of
+_sweepSeries = None
+
+def _loadSweepSeries(tickers, matrixFiles, initialPortfolio):
+    global _sweepSeries
+    matrices = {name: np.memmap(path, dtype=np.float64, mode='r', shape=shape) for name, (path, shape) in matrixFiles.items()}
+    _sweepSeries = (tickers, matrices["timestamps"], matrices["prices"], matrices["pricesSek"], initialPortfolio)
+
+def _runSweepVariant(variant):
+    tickers, timestamps, prices, pricesSek, initialPortfolio = _sweepSeries
+    return runVariant(tickers, timestamps, prices, pricesSek, initialPortfolio, variant)
+
+def runSweep(series, variants, initialPortfolio=None, processes=None):
+    """
+    Runs the variants on a pool of processes, a worker runs one variant at a
+    time and undoes its Analyze overrides before the next. Returns the reports
+    in variants order.
+    The aligned price matrices are written once to files in the temp directory
+    (TMPDIR) and every worker memory maps them, so all workers share one copy
+    in the page cache and a task only carries its variant.
+    """
+    tickers, timestamps, prices, pricesSek = alignSeries(series)
+
+    with tempfile.TemporaryDirectory(prefix="backtest") as directory:
+        matrixFiles = {}
+        for name, matrix in (("timestamps", timestamps), ("prices", prices), ("pricesSek", pricesSek)):
+            path = os.path.join(directory, name + ".bin")
+            matrix.astype(np.float64).tofile(path)
+            matrixFiles[name] = (path, matrix.shape)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_loadSweepSeries,
+                                                    initargs=(tickers, matrixFiles, initialPortfolio)) as pool:
+            return list(pool.map(_runSweepVariant, variants))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest Analyze against recorded prices")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--history", help="PriceHistory directory (TP_HISTORY_DIR)")
+    source.add_argument("--csv", help="csv file with timestamp,ticker,price[,price_in_sek]")
+    parser.add_argument("--portfolio", help="json file with the starting assets, ticker -> asset entry")
+    parser.add_argument("--sweep", help="json file with a list of variants, each a dict of Analyze overrides")
+    parser.add_argument("--processes", type=int, default=None)
+    arguments = parser.parse_args()
+
+    series = loadPriceHistory(arguments.history) if arguments.history else loadCsv(arguments.csv)
+    if len(series) == 0:
+        sys.exit("No prices found")
+
+    initialPortfolio = None
+    if arguments.portfolio:
+        with open(arguments.portfolio) as portfolioFile:
+            initialPortfolio = json.load(portfolioFile)
+
+    variants = [{}]
+    if arguments.sweep:
+        with open(arguments.sweep) as sweepFile:
+            variants = json.load(sweepFile)
+
+    print(json.dumps(runSweep(series, variants, initialPortfolio, arguments.processes), indent=4))
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import threading
+import tracemalloc
+import http.server
+import multiprocessing
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs, unquote
+import StocksFetcher
+import MarketOpenHours
+import HttpClient
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+#
+# Offline benchmarks. Nothing in here talks to the internet, run it with
+# >> python3 Benchmark.py
+# The refresh cycle benchmark serves yahoo and 4-traders from a local fake server
+# and uses mongomock as mongo, or a local mongod given with
+# >> python3 Benchmark.py --mongo mongodb://localhost:27017
+# (its TP.stockAssets collection is dropped!). Output is json, for comparing commits.
+#
+
+CYCLE_SIZES = (10, 100, 1000, 10000)
+MARKET_SUFFIXES = {".ST": "SEK", ".OL": "NOK", ".DE": "EUR", ".HE": "EUR", ".CO": "DKK", ".TO": "CAD", "": "USD"}
+
+def makeKeyStatisticsPage(fillerRows=20000):
+
+    statistics = {valueName: {"raw": round(random.uniform(1, 100), 2), "fmt": "x"} for valueName in StocksFetcher.STATIC_VALUE_NAMES}
+    filler = "".join(f'<tr><td class="row">Row {i}</td><td>{random.random()}</td></tr>' for i in range(fillerRows))
+    page = f'<html><head><title>key-statistics</title></head><body><table>{filler}</table>' \
+           f'<script>root.App.main = {{"context":{{"QuoteSummaryStore":{{"defaultKeyStatistics":{json.dumps(statistics)}}}}}}};</script>' \
+           f'</body></html>'
+    return page.encode('utf-8'), statistics
+
+def _measure(function, iterations):
+
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    retained = [function() for _ in range(iterations)]
+    elapsed = time.perf_counter() - startTime
+    retainedBytes, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+
+    return {"msPerTicker": 1000 * elapsed / iterations,
+            "retainedKbPerTicker": retainedBytes / 1024 / iterations,
+            "peakKb": peakBytes / 1024}
+
+def benchmarkStaticExtraction(iterations=20, fillerRows=20000):
+
+    fetcher = StocksFetcher.StocksFetcher()
+    pageData, statistics = makeKeyStatisticsPage(fillerRows)
+    results = {"pageKb": len(pageData) / 1024}
+
+    def compactPath():
+        values = fetcher.extractStaticValues(pageData.decode('utf-8', errors='replace'))
+        assert values._asdict() == {k: v["raw"] for k, v in statistics.items()}
+        return values
+
+    results["compact"] = _measure(compactPath, iterations)
+
+    if BeautifulSoup is not None:
+        def soupPath():
+            soup = BeautifulSoup(pageData, 'lxml')
+            for valueName in StocksFetcher.STATIC_VALUE_NAMES:
+                fetcher.extractStaticValue(valueName, str(soup))
+            return soup
+
+        results["beautifulSoup"] = _measure(soupPath, iterations)
+    else:
+        results["beautifulSoup"] = "bs4 not installed, skipped"
+
+    return results
+
+def benchmarkMarketOpenHours(tickerCount=1000, iterations=20):
+
+    suffixes = list(MarketOpenHours.MarketOpenHours.MARKET_OPEN_HOURS.keys())[:-1] + [""]
+    tickers = [f"TICK{i}{suffixes[i % len(suffixes)]}" for i in range(tickerCount)]
+    results = {"tickers": tickerCount}
+
+    startTime = time.perf_counter()
+    marketOpenHours = MarketOpenHours.MarketOpenHours(MarketOpenHours.HolidayCalendar())
+    for ticker in tickers:
+        marketOpenHours.isMarketOpen(ticker)
+    results["coldUsPerTicker"] = 1000000 * (time.perf_counter() - startTime) / tickerCount
+
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        now = time.time()
+        for ticker in tickers:
+            marketOpenHours.isMarketOpen(ticker, now)
+    results["warmUsPerTicker"] = 1000000 * (time.perf_counter() - startTime) / (tickerCount * iterations)
+
+    return results
+
+class FakeUpstream(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for yahoo (quoteSummary, batch quote, key-statistics) and the
+    4-traders currency pages. Every request waits latencySec, and errorRate of
+    them get a 503.
+    """
+    latencySec = 0.0
+    errorRate = 0.0
+    keyStatisticsPage = b""
+
+    def do_GET(self):
+
+        time.sleep(self.latencySec)
+        if random.random() < self.errorRate:
+            self._send(503, b"injected error")
+            return
+
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        args = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if parts[:3] == ["v10", "finance", "quoteSummary"]:
+            if args.get("modules") == "summaryProfile":
+                result = {"summaryProfile": {"industry": random.choice(["Banks", "Oil & Gas", "Telecom", "Software"]), "fullTimeEmployees": 1000}}
+            else:
+                result = {"financialData": {"currentPrice": {"raw": self._price(parts[3])}}}
+            self._send(200, json.dumps({"quoteSummary": {"result": [result], "error": None}}).encode('utf-8'))
+        elif parts[:3] == ["v7", "finance", "quote"]:
+            quotes = [{"symbol": symbol, "regularMarketPrice": self._price(symbol)} for symbol in args.get("symbols", "").split(",")]
+            self._send(200, json.dumps({"quoteResponse": {"result": quotes, "error": None}}).encode('utf-8'))
+        elif parts[:1] == ["quote"]:
+            self._send(200, self.keyStatisticsPage)
+        elif parts[:1] == ["currency"]:
+            self._send(200, f'<html><table><tr><td class="fvPrice colorBlack">{random.uniform(0.8, 11):.4f}</td></tr></table></html>'.encode('utf-8'))
+        else:
+            self._send(404, b"not found")
+
+    def _price(self, ticker):
+        return round(10 + (hash(ticker) % 1000) + random.uniform(-1, 1), 2)
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def startFakeUpstream(latencySec=0.0, errorRate=0.0):
+
+    FakeUpstream.latencySec = latencySec
+    FakeUpstream.errorRate = errorRate
+    FakeUpstream.keyStatisticsPage = makeKeyStatisticsPage(fillerRows=2000)[0]
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstream)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def makeFakeFetcher(baseUrl):
+
+    for currency in StocksFetcher.currency_urls:
+        StocksFetcher.currency_urls[currency] = f"{baseUrl}/currency/{currency}"
+
+    fetcher = StocksFetcher.StocksFetcher(cacheDirectory=None)
+    fetcher.QUOTE_SUMMARY_URL = baseUrl + "/v10/finance/quoteSummary/{0}?modules={1}"
+    fetcher.BATCH_QUOTE_URL = baseUrl + "/v7/finance/quote?symbols={0}"
+    fetcher.KEY_STATISTICS_URL = baseUrl + "/quote/{0}/key-statistics"
+    # The fake server is not rate limited, measure the code and not the limiter
+    fetcher.http.rateLimiter = HttpClient.RateLimiter(defaultRate=(1000000.0, 1000000))
+    return fetcher
+
+def makeMongoClient(mongoUrl, tickerCount):
+
+    if mongoUrl is not None:
+        import pymongo
+        if urlsplit(mongoUrl).hostname not in ("localhost", "127.0.0.1"):
+            raise ValueError("The benchmark drops TP.stockAssets, only a local mongod is allowed")
+        client = pymongo.MongoClient(mongoUrl)
+    elif mongomock is not None:
+        client = mongomock.MongoClient()
+    else:
+        raise RuntimeError("Install mongomock or give a local mongod with --mongo")
+
+    import FileHandler
+    collection = client[FileHandler.databaseName][FileHandler.collectionNameStockAssets]
+    collection.drop()
+
+    suffixes = list(MARKET_SUFFIXES.items())
+    documents = []
+    for i in range(tickerCount):
+        suffix, currency = suffixes[i % len(suffixes)]
+        documents.append({"ticker": f"BENCH{i}{suffix}", "name": f"Bench company {i}", "count": 10, "lockKey": 0, "lockCounter": 0,
+                          "boughtAt": None, "soldAt": None, "currency": currency, "totalInvestedSek": 1000})
+    collection.insert_many(documents)
+
+    return client
+
+class AlwaysOpenMarketHours(MarketOpenHours.MarketOpenHours):
+
+    def isMarketKeyOpen(self, market, now=None):
+        return True
+
+def _peakRssKb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measureThroughput(client, path, durationSec, headers=None):
+
+    requestCount = 0
+    status = None
+    startTime = time.perf_counter()
+    while time.perf_counter() - startTime < durationSec:
+        status = client.get(path, headers=headers).status_code
+        requestCount += 1
+
+    elapsed = time.perf_counter() - startTime
+    return {"requestsPerSec": round(requestCount / elapsed, 1), "status": status}
+
+def benchmarkRefreshCycle(tickerCount, cycles=3, latencySec=0.005, errorRate=0.0, mongoUrl=None, endpointSec=1.0):
+    """
+    Runs cycles full refreshes of a tickerCount portfolio through RestServer's
+    wiring, then measures the read endpoints. The first cycle is cold (profiles
+    and currencies are fetched), the rest only fetch prices.
+    """
+    import RestServer
+
+    server, baseUrl = startFakeUpstream(latencySec, errorRate)
+    RestServer.init(mongoClient=makeMongoClient(mongoUrl, tickerCount), fetcher=makeFakeFetcher(baseUrl),
+                    marketOpenHours=AlwaysOpenMarketHours(MarketOpenHours.HolidayCalendar()), startScheduler=False)
+
+    results = {"tickers": tickerCount, "latencySec": latencySec, "errorRate": errorRate, "cycles": []}
+    for _ in range(cycles):
+        RestServer.stockWatcher.updateAllStocks()
+        results["cycles"].append({name: round(value, 4) if isinstance(value, float) else value
+                                  for name, value in RestServer.stockWatcher.getCycleTimings().items()})
+
+    snapshot = RestServer.stockWatcher.getSnapshot()
+    results["successCounter"] = snapshot.allStocks.get("successCounter")
+    results["failCounter"] = snapshot.allStocks.get("failCounter")
+    results["allStocksKb"] = round(len(snapshot.allStocksJson) / 1024, 1)
+
+    client = RestServer.app.test_client()
+    results["endpoints"] = {
+        "getAllStocks": _measureThroughput(client, "/tradingpal/getAllStocks", endpointSec),
+        "getAllStocksNotModified": _measureThroughput(client, "/tradingpal/getAllStocks", endpointSec, {"If-None-Match": f'"{snapshot.etag}"'}),
+        "getStocksToBuy": _measureThroughput(client, "/tradingpal/getStocksToBuy", endpointSec),
+        "getTickerValue": _measureThroughput(client, f"/tradingpal/getTickerValue?ticker=BENCH0.ST&currency=SEK", endpointSec),
+    }
+
+    results["fetcher"] = RestServer.stocksFetcher.getStats()
+    results["peakRssKb"] = _peakRssKb()
+    server.shutdown()
+
+    return results
+
+def benchmarkRefreshCycles(sizes=CYCLE_SIZES, **kwargs):
+    """
+    Every size runs in a fresh process, so peak RSS and caches do not carry over.
+    """
+    results = []
+    for tickerCount in sizes:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results.append(pool.submit(_quietly, benchmarkRefreshCycle, tickerCount, **kwargs).result())
+
+    return results
+
+def _quietly(function, *args, **kwargs):
+    # The watcher and fetcher log every cycle, keep stdout for the json
+    sys.stdout = open(os.devnull, 'w')
+    return function(*args, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in CYCLE_SIZES), help="portfolio sizes for the refresh cycle benchmark")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.005, help="fake upstream latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake upstream requests that fail")
+    parser.add_argument("--mongo", default=None, help="local mongod url, mongomock is used if not given")
+    parser.add_argument("--skip-micro", action="store_true", help="only run the refresh cycle benchmark")
+    arguments = parser.parse_args()
+
+    results = {}
+    if not arguments.skip_micro:
+        results["staticExtraction"] = benchmarkStaticExtraction()
+        results["marketOpenHours"] = benchmarkMarketOpenHours()
+
+    sizes = [int(size) for size in arguments.sizes.split(",") if size]
+    results["refreshCycle"] = benchmarkRefreshCycles(sizes, cycles=arguments.cycles, latencySec=arguments.latency,
+                                                     errorRate=arguments.error_rate, mongoUrl=arguments.mongo)
+
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,50 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+class FetchCache:
+
+    DATABASE_FILE_NAME = "fetchcache.sqlite"
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self.DATABASE_FILE_NAME)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, storedAt TEXT NOT NULL, PRIMARY KEY (kind, key))")
+        self.connection.commit()
+        print(f"Using persistent fetch cache {self.path}")
+
+    def put(self, kind, key, value, storedAt):
+        self.putMany(kind, {key: value}, storedAt)
+
+    def putMany(self, kind, values, storedAt):
+
+        rows = [(kind, key, json.dumps(value), storedAt.isoformat()) for key, value in values.items()]
+
+        try:
+            with self.lock:
+                self.connection.executemany("INSERT OR REPLACE INTO entries (kind, key, value, storedAt) VALUES (?, ?, ?, ?)", rows)
+                self.connection.commit()
+        except Exception as ex:
+            print(f"Could not write to persistent fetch cache ({ex})")
+
+    def load(self, kind):
+
+        retData = {}
+
+        try:
+            with self.lock:
+                rows = self.connection.execute("SELECT key, value, storedAt FROM entries WHERE kind = ?", (kind,)).fetchall()
+        except Exception as ex:
+            print(f"Could not read persistent fetch cache ({ex})")
+            return retData
+
+        for key, value, storedAt in rows:
+            retData[key] = (json.loads(value), datetime.fromisoformat(storedAt))
+
+        return retData
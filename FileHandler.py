@@ -1,6 +1,12 @@
 import copy
+import time
+import itertools
+import collections
+import threading
 import datetime, pytz
-from pymongo import ASCENDING, MongoClient
+from pymongo import ASCENDING, MongoClient, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError
+from bson import ObjectId
 import os
 
 PRODUCTION = os.getenv('TP_PROD')
@@ -11,27 +17,50 @@ else:
     print("Running in dev mode cause environment variable \"TP_PROD=true\" was not set...")
     PRODUCTION = None
 
-AUTO_RELEASE_LOCKS_AFTER = 3
-
-mongoPort = 27018
-mongoHost = "192.168.1.50"
+LOCK_TIMEOUT_SEC = 20 * 60
+CHANGE_LOG_TTL_DAYS = 90
+MAX_CHANGE_LOG_WAIT_SEC = 30
+CHANGE_LOG_POLL_SEC = 1
+ASSET_POLL_INTERVAL_SEC = 5
+ASSET_FULL_RESYNC_SEC = 300
+# The $changeStream stage is only supported on replica sets
+CHANGE_STREAM_NOT_SUPPORTED_CODES = (40573,)
+NEVER_MODIFIED = datetime.datetime(1970, 1, 1)
+
+mongoPort = int(os.getenv('TP_MONGO_PORT', 27018))
+mongoHost = os.getenv('TP_MONGO_HOST', "192.168.1.50")
 databaseName = "TP"
 collectionNameStockAssets = f"stockAssets"
+collectionNameChangeLog = f"stockChangeLog"
+collectionNameCounters = f"counters"
 
 class FileHandler:
 
     def __init__(self):
         self.lastFileHash = 0
-        self.changeLog = []
-
-    def init(self):
-        self.DB, self.COLLECTION, self.MONGO_CLIENT = self._connectDb(mongoHost, mongoPort, databaseName, collectionNameStockAssets)
+        self.changeLog = collections.deque()
+        self.changeLogCondition = threading.Condition()
+        self.lastChangeLogSeq = 0
+        self.deliveredChangeLogSeqs = set()
+        self.changeLogWrites = 0
+        self.assetCache = {}
+        self.assetIds = {}
+        self.assetCacheLock = threading.Lock()
+        self.lastModifiedSeen = NEVER_MODIFIED
+        self.lastIdSeen = None
+        self.otherDocumentCount = 0
+
+    def init(self, mongoClient=None):
+        self.DB, self.COLLECTION, self.MONGO_CLIENT = self._connectDb(mongoHost, mongoPort, databaseName, collectionNameStockAssets, mongoClient)
         self._testMongoConnection(self.MONGO_CLIENT)
         self._fixIndex()
+        self._loadChangeLog()
+        self._loadAssetCache()
+        threading.Thread(target=self._followAssetChanges, name="AssetChanges", daemon=True).start()
 
-    def _connectDb(self, mongoHost, mongoPort, databaseName, collectionName):
+    def _connectDb(self, mongoHost, mongoPort, databaseName, collectionName, mongoClient=None):
 
-        dbConnection = MongoClient(host=mongoHost, port=mongoPort)
+        dbConnection = MongoClient(host=mongoHost, port=mongoPort) if mongoClient is None else mongoClient
         db = dbConnection[databaseName]
         collection = db[collectionName]
         return db, collection, dbConnection
@@ -45,61 +74,257 @@ class FileHandler:
 
     def _fixIndex(self):
         self.DB[collectionNameStockAssets].create_index([('ticker', ASCENDING)], unique=True)
+        self.DB[collectionNameStockAssets].create_index([('lastModified', ASCENDING)])
+        self.DB[collectionNameChangeLog].create_index([('seq', ASCENDING)], unique=True)
+        self.DB[collectionNameChangeLog].create_index([('createdAt', ASCENDING)], expireAfterSeconds=CHANGE_LOG_TTL_DAYS * 24 * 60 * 60)
 
     def readAssetsFromMongo(self):
+        """
+        Served from the in-memory copy of the collection, no database round trip.
+        """
+        with self.assetCacheLock:
+            return copy.deepcopy(self.assetCache)
+
+    def _loadAssetCache(self):
+
+        assetCache = {}
+        assetIds = {}
+        lastModifiedSeen = NEVER_MODIFIED
+        lastIdSeen = None
+        otherDocumentCount = 0
+
+        for document in self.COLLECTION.find():
+            if isinstance(document['_id'], ObjectId) and (lastIdSeen is None or document['_id'] > lastIdSeen):
+                lastIdSeen = document['_id']
+            if 'ticker' not in document:
+                otherDocumentCount += 1
+                continue
+            ticker, entry, lastModified = self._splitAssetDocument(document)
+            assetCache[ticker] = entry
+            assetIds[document['_id']] = ticker
+            if lastModified is not None and lastModified > lastModifiedSeen:
+                lastModifiedSeen = lastModified
+
+        with self.assetCacheLock:
+            self.assetCache = assetCache
+            self.assetIds = assetIds
+            self.lastModifiedSeen = lastModifiedSeen
+            self.lastIdSeen = lastIdSeen
+            self.otherDocumentCount = otherDocumentCount
+
+    def _splitAssetDocument(self, document):
+
+        entry = dict(document)
+        ticker = entry.pop('ticker')
+        del(entry['_id'])
+        lastModified = entry.pop('lastModified', None)
+        return ticker, entry, lastModified
+
+    def _storeAssetDocument(self, document):
+
+        ticker, entry, lastModified = self._splitAssetDocument(document)
+
+        with self.assetCacheLock:
+            self.assetCache[ticker] = entry
+            self.assetIds[document['_id']] = ticker
+            if lastModified is not None and lastModified > self.lastModifiedSeen:
+                self.lastModifiedSeen = lastModified
+            if isinstance(document['_id'], ObjectId) and (self.lastIdSeen is None or document['_id'] > self.lastIdSeen):
+                self.lastIdSeen = document['_id']
+
+    def _followAssetChanges(self):
+        """
+        Keeps the asset cache current with writes from any service. Uses a change
+        stream, and falls back to polling when the server has no change streams
+        (standalone mongod, in-process stand-ins like mongomock). That is decided
+        once, when the first stream is opened.
+        """
+        while True:
+            try:
+                stream = self._openAssetChangeStream()
+            except Exception as ex:
+                print(f"Could not open asset change stream, retrying ({ex})")
+                time.sleep(ASSET_POLL_INTERVAL_SEC)
+                continue
 
-        data = self.COLLECTION.find()
-        retData = {}
-
-        for entry in data:
-            ticker = entry['ticker']
-            del(entry['ticker'])
-            del(entry['_id'])
-            retData[ticker] = entry
-
-        return retData
-
-    def writeAssetsToMongo(self, file):
-
-        for ticker, entry in file.items():
-            newEntry = copy.deepcopy(entry)
-            newEntry['ticker'] = ticker
-
-            if PRODUCTION:
-                self.COLLECTION.update_one(
-                    {"ticker": ticker},
-                    {"$set":
-                         newEntry
-                    },
-                    upsert=True)
-
-    def incrementLockCounter(self, file):
-
-        changes = False
-
-        for stock, stockData in file.items():
-            if "lockCounter" not in stockData:
-                changes = True
-                stockData["lockCounter"] = 0
+            if stream is None:
+                print("No change streams on this server, polling for asset changes instead")
+                self._pollAssetChanges()
+                return
 
-            if "lockKey" not in stockData:
-                changes = True
-                stockData["lockKey"] = 0
+            try:
+                with stream:
+                    self._loadAssetCache()
+                    for change in stream:
+                        self._applyAssetChange(change)
+            except Exception as ex:
+                print(f"Asset change stream failed, reopening ({ex})")
+                time.sleep(ASSET_POLL_INTERVAL_SEC)
 
-            if stockData["lockKey"] == 0:
-                stockData["lockCounter"] = 0
-                continue
+    def _openAssetChangeStream(self):
+        # Returns None if the server does not support change streams
 
-            stockData["lockCounter"] += 1
-            changes = True
-
-            if stockData["lockCounter"] > AUTO_RELEASE_LOCKS_AFTER:
-                print("Releasing lock due to inactivity")
-                changes = True
-                stockData["lockCounter"] = 0
-                stockData["lockKey"] = 0
+        try:
+            return self.COLLECTION.watch(full_document='updateLookup')
+        except OperationFailure as ex:
+            if ex.code in CHANGE_STREAM_NOT_SUPPORTED_CODES:
+                return None
+            raise
+        except (NotImplementedError, TypeError, AttributeError):
+            # mongomock has no watch, collection.watch is a sub collection there
+            return None
+
+    def _applyAssetChange(self, change):
+
+        operationType = change['operationType']
+
+        if operationType in ('insert', 'update', 'replace'):
+            if change.get('fullDocument') is not None and 'ticker' in change['fullDocument']:
+                self._storeAssetDocument(change['fullDocument'])
+        elif operationType == 'delete':
+            with self.assetCacheLock:
+                ticker = self.assetIds.pop(change['documentKey']['_id'], None)
+                if ticker is not None:
+                    self.assetCache.pop(ticker, None)
+        elif operationType in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+            raise RuntimeError(f"Change stream got {operationType}")
+
+    def _pollAssetChanges(self):
+        """
+        Every poll only reads what changed, through indexes: documents with a
+        lastModified at or after the newest one seen, and documents with an _id
+        after the newest one seen, which are the inserts. A document count that
+        does not match the cache means something was deleted, and the cache is
+        reloaded. Updates from writers that do not set lastModified are picked up
+        by the full reload every ASSET_FULL_RESYNC_SEC.
+        """
+        lastFullResync = time.time()
+
+        while True:
+            time.sleep(ASSET_POLL_INTERVAL_SEC)
+            try:
+                if time.time() - lastFullResync > ASSET_FULL_RESYNC_SEC:
+                    self._loadAssetCache()
+                    lastFullResync = time.time()
+                    continue
+
+                with self.assetCacheLock:
+                    lastModifiedSeen = self.lastModifiedSeen
+                    lastIdSeen = self.lastIdSeen
+
+                changedDocuments = list(self.COLLECTION.find({'lastModified': {'$gte': lastModifiedSeen}}))
+                if lastIdSeen is not None:
+                    changedDocuments += list(self.COLLECTION.find({'_id': {'$gt': lastIdSeen}}))
+
+                for document in changedDocuments:
+                    if 'ticker' in document:
+                        self._storeAssetDocument(document)
+
+                with self.assetCacheLock:
+                    knownDocumentCount = len(self.assetIds) + self.otherDocumentCount
+                if self.COLLECTION.estimated_document_count() != knownDocumentCount:
+                    self._loadAssetCache()
+                    lastFullResync = time.time()
+            except Exception as ex:
+                print(f"Polling for asset changes failed ({ex})")
+
+    def readAsset(self, ticker):
+
+        with self.assetCacheLock:
+            return copy.deepcopy(self.assetCache.get(ticker))
+
+    def lockAsset(self, ticker, lockKey):
+        """
+        Locks ticker with lockKey, if it exists and is not locked. Returns True if
+        this call took the lock.
+        """
+        return self._updateAssetIfLockKey(ticker, 0, {"lockKey": lockKey, "lockCounter": 0, "lockedAt": time.time()}) is not None
+
+    def unlockAsset(self, ticker, lockKey):
+        return self._updateAssetIfLockKey(ticker, lockKey, {"lockKey": 0, "lockCounter": 0}) is not None
+
+    def updateAsset(self, ticker, expectedLockKey, entry):
+        """
+        Sets all fields of entry on ticker, provided it is still locked with
+        expectedLockKey. With expectedLockKey None the ticker must not have a
+        lockKey, or not exist at all in which case it is created.
+        Returns the stored entry, or None if the lockKey did not match.
+        """
+        return self._updateAssetIfLockKey(ticker, expectedLockKey, entry)
+
+    def deleteAsset(self, ticker, lockKey):
+
+        if not PRODUCTION:
+            with self.assetCacheLock:
+                if ticker not in self.assetCache or self.assetCache[ticker].get("lockKey") != lockKey:
+                    return False
+                del(self.assetCache[ticker])
+                return True
+
+        document = self.COLLECTION.find_one_and_delete({"ticker": ticker, "lockKey": lockKey})
+        if document is None:
+            return False
+
+        with self.assetCacheLock:
+            self.assetCache.pop(ticker, None)
+            self.assetIds.pop(document["_id"], None)
+        return True
+
+    def _updateAssetIfLockKey(self, ticker, expectedLockKey, fields):
+        """
+        One atomic find_one_and_update with the lockKey check in the filter, so
+        concurrent mutations of different tickers, also from other RestServer
+        replicas, never need a common lock. In dev mode only the cache is updated.
+        """
+        if not PRODUCTION:
+            with self.assetCacheLock:
+                entry = self.assetCache.get(ticker)
+                if entry is None and expectedLockKey is None:
+                    entry = self.assetCache[ticker] = {}
+                if entry is None or entry.get("lockKey") != expectedLockKey:
+                    return None
+                entry.update(copy.deepcopy(fields))
+                return copy.deepcopy(entry)
+
+        lockFilter = {"$exists": False} if expectedLockKey is None else expectedLockKey
+        update = {"$set": {**fields, "lastModified": datetime.datetime.utcnow()}}
 
-        return changes
+        try:
+            document = self.COLLECTION.find_one_and_update({"ticker": ticker, "lockKey": lockFilter}, update,
+                                                           upsert=expectedLockKey is None,
+                                                           return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            return None
+
+        if document is None:
+            return None
+
+        self._storeAssetDocument(document)
+        return self._splitAssetDocument(document)[1]
+
+    def releaseExpiredLocks(self):
+        """
+        Unlocks tickers that have been locked for more than LOCK_TIMEOUT_SEC. Locks
+        without a lockedAt time, taken before locks had one, get one now.
+        """
+        expiredBefore = time.time() - LOCK_TIMEOUT_SEC
+
+        if not PRODUCTION:
+            with self.assetCacheLock:
+                for ticker, entry in self.assetCache.items():
+                    if entry.get("lockKey", 0) != 0 and entry.get("lockedAt", time.time()) < expiredBefore:
+                        print(f"Releasing lock on {ticker} due to inactivity")
+                        entry.update({"lockKey": 0, "lockCounter": 0})
+            return
+
+        now = datetime.datetime.utcnow()
+        self.COLLECTION.update_many({"lockKey": {"$ne": 0}, "lockedAt": {"$exists": False}},
+                                    {"$set": {"lockedAt": time.time(), "lastModified": now}})
+        released = self.COLLECTION.update_many({"lockKey": {"$ne": 0}, "lockedAt": {"$lt": expiredBefore}},
+                                               {"$set": {"lockKey": 0, "lockCounter": 0, "lastModified": now}})
+        if released.modified_count > 0:
+            print(f"Released {released.modified_count} locks due to inactivity")
+            self._loadAssetCache()
 
     def writeStockChangeLog(self, oldStock, newStock, tradedByBot):
 
@@ -111,16 +336,105 @@ class FileHandler:
         entry["tradedByBot"] = tradedByBot
         del(entry["lockCounter"])
         del (entry["lockKey"])
+        entry.pop("lockedAt", None)
+        entry["seq"] = self._nextChangeLogSeq()
+
+        if PRODUCTION:
+            self.DB[collectionNameChangeLog].insert_one({**entry, "createdAt": datetime.datetime.utcnow(), "acked": False})
+
         print(f"Added to stock changelog: {entry}")
-        self.changeLog.append(entry)
+        with self.changeLogCondition:
+            if not PRODUCTION:
+                self.changeLog.append(entry)
+            self.changeLogWrites += 1
+            self.changeLogCondition.notify_all()
+
+    def _nextChangeLogSeq(self):
+
+        if not PRODUCTION:
+            with self.changeLogCondition:
+                self.lastChangeLogSeq += 1
+                return self.lastChangeLogSeq
+
+        counter = self.DB[collectionNameCounters].find_one_and_update({"_id": collectionNameChangeLog}, {"$inc": {"seq": 1}},
+                                                                     upsert=True, return_document=ReturnDocument.AFTER)
+        return counter["seq"]
+
+    def _loadChangeLog(self):
+
+        if PRODUCTION:
+            pendingCount = self.DB[collectionNameChangeLog].count_documents({"acked": False})
+            if pendingCount > 0:
+                print(f"{pendingCount} unacknowledged stock changelog items in {collectionNameChangeLog}")
+
+    def takeChangeLogItems(self, maxItems, ackSeq=None, waitSec=0):
+        """
+        Returns up to maxItems unacknowledged changelog items, oldest first. Items
+        stay in the log until they are acknowledged by passing the seq of the last
+        processed item as ackSeq, in this or a later call. With waitSec, waits up to
+        that long for an item if there is none. In production the log lives in the
+        stockChangeLog collection and is shared by all RestServer replicas, in dev
+        mode it is the deque of this process.
+        """
+        if ackSeq is not None:
+            self.ackChangeLog(ackSeq)
+
+        deadline = time.time() + min(waitSec, MAX_CHANGE_LOG_WAIT_SEC)
+
+        while True:
+            with self.changeLogCondition:
+                changeLogWrites = self.changeLogWrites
+
+            items = self._pendingChangeLogItems(maxItems)
+            remainingSec = deadline - time.time()
+            if len(items) > 0 or remainingSec <= 0:
+                return items
+
+            # Woken up by writes from this process, items from other replicas are
+            # only seen by reading the collection again, the deque is not used for that
+            with self.changeLogCondition:
+                self.changeLogCondition.wait_for(lambda: self.changeLogWrites != changeLogWrites,
+                                                 timeout=min(remainingSec, CHANGE_LOG_POLL_SEC) if PRODUCTION else remainingSec)
+
+    def _pendingChangeLogItems(self, maxItems):
+
+        if not PRODUCTION:
+            with self.changeLogCondition:
+                items = list(itertools.islice(self.changeLog, maxItems))
+                self.deliveredChangeLogSeqs.update(item["seq"] for item in items)
+            return items
+
+        items = list(self.DB[collectionNameChangeLog].find({"acked": False}, {"_id": 0, "createdAt": 0, "acked": 0, "deliveredAt": 0})
+                                                     .sort("seq", ASCENDING).limit(maxItems))
+        if len(items) > 0:
+            self.DB[collectionNameChangeLog].update_many({"seq": {"$in": [item["seq"] for item in items]}, "deliveredAt": {"$exists": False}},
+                                                         {"$set": {"deliveredAt": datetime.datetime.utcnow()}})
+        return items
+
+    def ackChangeLog(self, ackSeq):
+        """
+        Acknowledges the delivered items up to ackSeq. Seqs are taken before the
+        insert, so an item with a lower seq can show up after a higher one was
+        delivered, and it stays pending until it has been delivered too.
+        """
+        if not PRODUCTION:
+            with self.changeLogCondition:
+                ackedSeqs = {seq for seq in self.deliveredChangeLogSeqs if seq <= ackSeq}
+                self.changeLog = collections.deque(item for item in self.changeLog if item["seq"] not in ackedSeqs)
+                self.deliveredChangeLogSeqs -= ackedSeqs
+            return
+
+        self.DB[collectionNameChangeLog].update_many({"seq": {"$lte": ackSeq}, "acked": False, "deliveredAt": {"$exists": True}},
+                                                     {"$set": {"acked": True, "ackedAt": datetime.datetime.utcnow()}})
 
     def takeFirstChangeLogItem(self):
-        if len(self.changeLog) > 0:
-            retData = self.changeLog[0]
-            del(self.changeLog[0])
-            return retData
 
-        return {}
+        items = self.takeChangeLogItems(1)
+        if len(items) == 0:
+            return {}
+
+        self.ackChangeLog(items[0]["seq"])
+        return items[0]
 
 if __name__ == "__main__":
     f = FileHandler()
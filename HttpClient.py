@@ -0,0 +1,296 @@
+import time
+import random
+import threading
+import contextlib
+import concurrent.futures
+import urllib3
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+PRIORITY_REFRESH = 0
+PRIORITY_INTERACTIVE = 1
+
+# Statuses an upstream throttles with. They slow the rate limiter down, but say
+# nothing about the health of the host, so they never open the circuit breaker.
+THROTTLE_STATUSES = (429, 503)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    A token bucket per host. hostRates maps a host to (requestsPerSec, burst),
+    other hosts get defaultRate. A 429 or 503 from a host halves its rate, and a
+    Retry-After pauses it entirely; every successful response earns a bit of the
+    rate back. Refresh requests wait for a token, interactive requests may not
+    dip into the last INTERACTIVE_RESERVE of the bucket and are shed if they
+    would have to wait longer than maxInteractiveWaitSec.
+    """
+
+    INTERACTIVE_RESERVE = 0.5
+    MIN_RATE_SCALE = 0.1
+    RATE_RECOVERY_STEP = 0.05
+    MAX_RETRY_AFTER_SEC = 300
+
+    def __init__(self, hostRates=None, defaultRate=(5.0, 10), maxInteractiveWaitSec=2.0):
+        self.hostRates = hostRates if hostRates is not None else {}
+        self.defaultRate = defaultRate
+        self.maxInteractiveWaitSec = maxInteractiveWaitSec
+        self.condition = threading.Condition()
+        self.buckets = {}
+        self.stats = {'delayed': 0, 'throttled': 0, 'shed': 0}
+
+    def _bucket(self, host, now):
+
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            rate, burst = self.hostRates.get(host, self.defaultRate)
+            bucket = {'rate': rate, 'burst': burst, 'tokens': burst, 'refilledAt': now, 'rateScale': 1.0, 'pausedUntil': 0}
+            self.buckets[host] = bucket
+
+        bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['refilledAt']) * bucket['rate'] * bucket['rateScale'])
+        bucket['refilledAt'] = now
+        return bucket
+
+    def acquire(self, host, priority=PRIORITY_REFRESH):
+
+        startTime = time.time()
+        delayed = False
+
+        with self.condition:
+            while True:
+                now = time.time()
+                bucket = self._bucket(host, now)
+                tokensNeeded = 1 + (bucket['burst'] * self.INTERACTIVE_RESERVE if priority == PRIORITY_INTERACTIVE else 0)
+
+                if now >= bucket['pausedUntil'] and bucket['tokens'] >= tokensNeeded:
+                    bucket['tokens'] -= 1
+                    return
+
+                waitSec = max(bucket['pausedUntil'] - now, (tokensNeeded - bucket['tokens']) / (bucket['rate'] * bucket['rateScale']))
+
+                if priority == PRIORITY_INTERACTIVE and now + waitSec - startTime > self.maxInteractiveWaitSec:
+                    self.stats['shed'] += 1
+                    raise RateLimitedError(f"Too many requests to {host} right now, try again in {waitSec:.1f}s")
+
+                if not delayed:
+                    delayed = True
+                    self.stats['delayed'] += 1
+
+                self.condition.wait(waitSec)
+
+    def onResponse(self, host, response):
+
+        with self.condition:
+            bucket = self._bucket(host, time.time())
+
+            if response.status not in THROTTLE_STATUSES:
+                bucket['rateScale'] = min(1.0, bucket['rateScale'] + self.RATE_RECOVERY_STEP)
+                return
+
+            self.stats['throttled'] += 1
+            bucket['rateScale'] = max(self.MIN_RATE_SCALE, bucket['rateScale'] / 2)
+            bucket['tokens'] = min(bucket['tokens'], 0)
+
+            retryAfter = self._parseRetryAfter(response.headers.get('Retry-After'))
+            if retryAfter is not None:
+                bucket['pausedUntil'] = max(bucket['pausedUntil'], time.time() + min(retryAfter, self.MAX_RETRY_AFTER_SEC))
+
+    def _parseRetryAfter(self, retryAfter):
+
+        if retryAfter is None:
+            return None
+
+        try:
+            return max(0.0, float(retryAfter))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def getStats(self):
+
+        with self.condition:
+            return {**self.stats,
+                    'rateScale': {host: round(bucket['rateScale'], 2) for host, bucket in self.buckets.items()},
+                    'paused': [host for host, bucket in self.buckets.items() if bucket['pausedUntil'] > time.time()]}
+
+
+class HttpClient:
+    """
+    One pooled HTTP client for all upstream calls. Every attempt has a connect
+    and a read deadline, failed attempts (connection errors, timeouts and
+    RETRY_STATUSES) are retried a bounded number of times with jittered
+    exponential backoff, and a host that keeps failing is cut off by a circuit
+    breaker for BREAKER_OPEN_SEC so callers fail fast instead of queueing on it.
+    Idempotent requests may be hedged: if the first attempt has not answered
+    within hedgeAfterSec a duplicate is sent and whichever answers first wins.
+    Every attempt, hedges included, takes a token from the rateLimiter first.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    BREAKER_FAILURE_THRESHOLD = 5
+    BREAKER_OPEN_SEC = 60
+
+    def __init__(self, maxConnectionsPerHost=8, connectTimeoutSec=3.0, readTimeoutSec=10.0,
+                 maxRetries=2, backoffSec=0.5, hedgeAfterSec=2.0, rateLimiter=None):
+        self.maxRetries = maxRetries
+        self.backoffSec = backoffSec
+        self.hedgeAfterSec = hedgeAfterSec
+        self.pool = urllib3.PoolManager(maxsize=maxConnectionsPerHost, block=True, retries=False,
+                                        timeout=urllib3.Timeout(connect=connectTimeoutSec, read=readTimeoutSec))
+        self.hedgePool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * maxConnectionsPerHost)
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.rateLimiter = rateLimiter if rateLimiter is not None else RateLimiter()
+        self.context = threading.local()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'breakerRejections': 0, 'hedges': 0, 'hedgeWins': 0}
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """
+        Requests made on this thread inside the with block get the given priority.
+        """
+        previousPriority = getattr(self.context, 'priority', PRIORITY_REFRESH)
+        self.context.priority = priority
+        try:
+            yield
+        finally:
+            self.context.priority = previousPriority
+
+    def request(self, method, url, hedge=False, **kwargs):
+        """
+        Returns the response of the first successful attempt, or the last response
+        if every attempt came back with a retryable status. Raises the last error
+        if no attempt got a response at all, CircuitOpenError while the host is cut
+        off and RateLimitedError if an interactive request was shed.
+        """
+        host = urlsplit(url).netloc
+        priority = getattr(self.context, 'priority', PRIORITY_REFRESH)
+        self._count('requests')
+
+        lastError = None
+        for attempt in range(self.maxRetries + 1):
+            if attempt > 0:
+                self._count('retries')
+                time.sleep(self.backoffSec * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+            self._checkBreaker(host)
+            self.rateLimiter.acquire(host, priority)
+
+            try:
+                if hedge and self.hedgeAfterSec is not None:
+                    response = self._hedgedRequest(host, priority, method, url, **kwargs)
+                else:
+                    response = self.pool.request(method, url, **kwargs)
+            except urllib3.exceptions.HTTPError as ex:
+                lastError = ex
+                self._recordResult(host, False)
+                continue
+
+            self.rateLimiter.onResponse(host, response)
+
+            if response.status in self.RETRY_STATUSES:
+                if response.status not in THROTTLE_STATUSES:
+                    self._recordResult(host, False)
+                if attempt < self.maxRetries:
+                    continue
+                self._count('failures')
+                return response
+
+            self._recordResult(host, True)
+            return response
+
+        self._count('failures')
+        raise lastError
+
+    def _hedgedRequest(self, host, priority, method, url, **kwargs):
+
+        # The hedge timer starts once the primary leaves the hedgePool queue, time spent
+        # waiting for a free worker is ours and not the upstream's
+        started = threading.Event()
+
+        def requestPrimary():
+            started.set()
+            return self.pool.request(method, url, **kwargs)
+
+        primary = self.hedgePool.submit(requestPrimary)
+        started.wait()
+        done, _ = concurrent.futures.wait([primary], timeout=self.hedgeAfterSec)
+        if done:
+            return primary.result()
+
+        try:
+            self.rateLimiter.acquire(host, PRIORITY_INTERACTIVE)
+        except RateLimitedError:
+            return primary.result()
+
+        self._count('hedges')
+        hedged = self.hedgePool.submit(self.pool.request, method, url, **kwargs)
+        pending = {primary, hedged}
+        lastError = None
+
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedged:
+                        self._count('hedgeWins')
+                    return future.result()
+                lastError = future.exception()
+
+        raise lastError
+
+    def _checkBreaker(self, host):
+
+        with self.lock:
+            breaker = self.breakers.get(host)
+            if breaker is None or breaker['openUntil'] is None:
+                return
+
+            if time.time() < breaker['openUntil']:
+                self.stats['breakerRejections'] += 1
+                raise CircuitOpenError(f"Circuit open for {host}, not calling it for another {breaker['openUntil'] - time.time():.0f}s")
+
+            # Half open, let this request through as a trial. One more failure opens it again.
+            breaker['openUntil'] = None
+            breaker['failures'] = self.BREAKER_FAILURE_THRESHOLD - 1
+
+    def _recordResult(self, host, success):
+
+        with self.lock:
+            breaker = self.breakers.setdefault(host, {'failures': 0, 'openUntil': None, 'opened': 0})
+
+            if success:
+                breaker['failures'] = 0
+                return
+
+            breaker['failures'] += 1
+            if breaker['failures'] >= self.BREAKER_FAILURE_THRESHOLD and breaker['openUntil'] is None:
+                breaker['openUntil'] = time.time() + self.BREAKER_OPEN_SEC
+                breaker['opened'] += 1
+                print(f"Too many failures calling {host}, opening circuit for {self.BREAKER_OPEN_SEC}s")
+
+    def _count(self, counterName):
+        with self.lock:
+            self.stats[counterName] += 1
+
+    def getStats(self):
+
+        with self.lock:
+            stats = {**self.stats,
+                     'openCircuits': [host for host, breaker in self.breakers.items()
+                                      if breaker['openUntil'] is not None and time.time() < breaker['openUntil']]}
+
+        stats['rateLimiter'] = self.rateLimiter.getStats()
+        return stats
+
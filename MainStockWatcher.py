@@ -1,59 +1,66 @@
 import StocksFetcher
-import Analyze
+import PortfolioState
 import time
 import sys
-import copy
+import os
+import json
 import random
 import math
 import threading
+import concurrent.futures
+import collections
+import numpy as np
 import pytz
 import MarketOpenHours
+import Snapshot
 from datetime import datetime
 
+SNAPSHOT_DIRECTORY = os.getenv('TP_CACHE_DIR')
+
 class MainStockWatcher:
 
-    TIMER_DELAY_SEC = 3
+    MIN_SCHEDULER_DELAY_SEC = 3
     MIN_REFRESH_INTERVAL_SEC = 240
     MAX_REFRESH_INTERVAL_SEC = 600
+    CLOSED_MARKET_REFRESH_INTERVAL_SEC = 1800
+    MAX_CONCURRENT_FETCHES = 16
+    SNAPSHOT_FILE_NAME = "lastSnapshot.json"
+    SNAPSHOT_HISTORY_LENGTH = 30
+    TOTAL_NAMES = ("sellModeStocks", "buyModeStocks", "neutralModeStocks", "failCounter", "successCounter",
+                   "skippedCounter", "totalInvestedSek", "totalGlobalValueSek", "totalEmployees")
 
 
-    def __init__(self, fileHandler, stocksFetcher):
-        self.NEXT_REFRESH_INTERVAL_SEC = self.MIN_REFRESH_INTERVAL_SEC
-        self.timer = None
+    def __init__(self, fileHandler, stocksFetcher, snapshotDirectory=SNAPSHOT_DIRECTORY, priceHistory=None, marketOpenHours=None, startScheduler=True):
         self.FORCE_REFRESH = False
         self.QUICK_REFRESH = False
-        self.globalLock = threading.Lock()
+        self.refreshCondition = threading.Condition()
+        self.updateLock = threading.Lock()
         self.fileHandler = fileHandler
-        self.marketOpenHours = MarketOpenHours.MarketOpenHours()
+        self.marketOpenHours = marketOpenHours if marketOpenHours is not None else MarketOpenHours.MarketOpenHours()
         self.fetcher = stocksFetcher
-        self.cachedAllStocks = {}
-        self.cachedStocksToBuy = {}
-        self.cachedStocksToSell = {}
-        self.lastRefreshedTime = 0
-        self.timerCallback()
+        self.priceHistory = priceHistory
+        self.fetchPool = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_FETCHES)
+        self.snapshot = Snapshot.Snapshot({"list": [], "stale": True}, {"list": [], "stale": True}, {"list": [], "stale": True})
+        self.snapshotHistory = collections.deque(maxlen=self.SNAPSHOT_HISTORY_LENGTH)
+        self.publishListeners = []
+        self.marketRefreshDue = {}
+        self.marketOpenState = {}
+        self.tickerOrder = []
+        self.tickerContributions = {}
+        self.totals = {totalName: 0 for totalName in self.TOTAL_NAMES}
+        self.industries = {}
+        self.lastCycleTimings = {}
+        self.snapshotPath = None if snapshotDirectory is None else os.path.join(snapshotDirectory, self.SNAPSHOT_FILE_NAME)
+        self._loadPersistedSnapshot()
+        self.schedulerThread = threading.Thread(target=self._schedulerLoop, name="RefreshScheduler", daemon=True)
+        if startScheduler:
+            self.schedulerThread.start()
 
     def forceRefresh(self, QUICK_REFRESH=False):
-        self.FORCE_REFRESH = True
-        self.QUICK_REFRESH = QUICK_REFRESH
-
-    def reinitializeAllVariables(self):
-        self.FORCE_REFRESH = False
-        self.industries = {}
-        self.totalInvested = 0
-        self.totalEmployees = 0
-        self.successCounter = 0
-        self.skippedCounter = 0
-        self.sellModeStocks = 0
-        self.buyModeStocks = 0
-        self.neutralModeStocks = 0
-        self.totalGlobalValue = 0
-        self.allStocks = {}
-        self.allStocks["list"] = []
-        self.stocksToSell = {}
-        self.stocksToSell["list"] = []
-        self.stocksToBuy = {}
-        self.stocksToBuy["list"] = []
-        self.failedToLookup = []
+        with self.refreshCondition:
+            self.FORCE_REFRESH = True
+            self.QUICK_REFRESH = QUICK_REFRESH
+            self.refreshCondition.notify()
 
     def industryConverter(self, industry):
         if "bank" in industry.lower():
@@ -65,87 +72,254 @@ class MainStockWatcher:
 
         return industry
 
-    def timerCallback(self):
-        self.timer = None
-        try:
-            if self._shallStocksBeUpdated():
-                self.updateAllStocks()
-        finally:
-            self.timer = threading.Timer(self.TIMER_DELAY_SEC, self.timerCallback)
-            self.timer.start()
-            sys.stdout.flush()
+    def _schedulerLoop(self):
+        while True:
+            try:
+                markets, quickRefresh = self._marketsDueForRefresh()
+                if len(markets) > 0:
+                    self.updateMarkets(markets, quickRefresh)
+            except Exception as ex:
+                print(f"Refresh failed ({ex})")
+            finally:
+                sys.stdout.flush()
+
+            self._waitForNextRefresh()
+
+    def _marketsDueForRefresh(self):
+        """
+        Returns the markets to refresh now: all of them on a forced refresh,
+        otherwise those whose own refresh interval has passed and those that
+        opened or closed since they were last refreshed.
+        """
+        with self.refreshCondition:
+            if self.FORCE_REFRESH:
+                quickRefresh = self.QUICK_REFRESH
+                self.FORCE_REFRESH = False
+                self.QUICK_REFRESH = False
+                return self.marketOpenHours.getMarkets(), quickRefresh
+
+        now = time.time()
+        markets = [market for market in self.marketOpenHours.getMarkets()
+                   if self.marketRefreshDue.get(market, 0) <= now or self.marketOpenState.get(market) != self.marketOpenHours.isMarketKeyOpen(market, now)]
+
+        return markets, False
+
+    def _waitForNextRefresh(self):
+        """
+        Sleeps until the next market refresh is due, a market opens or closes,
+        or forceRefresh is called, whichever comes first.
+        """
+        with self.refreshCondition:
+            if self.FORCE_REFRESH:
+                return
+
+            nextMarketRefresh = min(self.marketRefreshDue.values(), default=0)
+            nextMarketTransition = self.marketOpenHours.nextTransition().timestamp() + 1
+            self.refreshCondition.wait(max(self.MIN_SCHEDULER_DELAY_SEC, min(nextMarketRefresh, nextMarketTransition) - time.time()))
+
+    def updateAllStocks(self, quickRefresh=False):
+        self.updateMarkets(self.marketOpenHours.getMarkets(), quickRefresh)
+
+    def updateMarkets(self, markets, quickRefresh=False):
+        """
+        Refreshes the tickers of the given markets only. Every ticker keeps its
+        contribution to the totals, the buy/sell lists and the industries, so a
+        refresh replaces the contributions of the refreshed tickers and leaves the
+        rest of the portfolio as it is.
+        """
+        with self.updateLock:
+            startTime = datetime.now(pytz.timezone('Europe/Stockholm'))
+            print(f"\n{startTime} - Updating markets {', '.join(str(market) for market in markets)}")
+            timings = {}
+            phaseStart = time.perf_counter()
+
+            try:
+                self.fileHandler.releaseExpiredLocks()
+            except Exception as ex:
+                print(f"Could not release expired locks ({ex})")
+
+            myStocks = self.fileHandler.readAssetsFromMongo()
+            self.tickerOrder = list(myStocks.keys())
+
+            for ticker in list(self.tickerContributions.keys()):
+                if ticker not in myStocks:
+                    self._replaceContribution(ticker, None)
+
+            now = time.time()
+            for market in markets:
+                marketIsOpen = self.marketOpenHours.isMarketKeyOpen(market, now)
+                self.marketOpenState[market] = marketIsOpen
+                self.marketRefreshDue[market] = now + (random.randint(self.MIN_REFRESH_INTERVAL_SEC, self.MAX_REFRESH_INTERVAL_SEC)
+                                                               if marketIsOpen else self.CLOSED_MARKET_REFRESH_INTERVAL_SEC)
 
-    def _shallStocksBeUpdated(self):
+            marketStocks = {nextStock: stockData for nextStock, stockData in myStocks.items() if self.marketOpenHours.getMarket(nextStock) in markets}
+            timings["readAssetsSec"], phaseStart = time.perf_counter() - phaseStart, time.perf_counter()
 
-        if self.marketOpenHours.marketsOpenedOrClosed() or self.FORCE_REFRESH or (self.lastRefreshedTime < (int(time.time()) - (self.NEXT_REFRESH_INTERVAL_SEC))):
-            return True
-        else:
-            return False
+            fetchedDetails, liveTickers = self._fetchAllStockDetails(marketStocks, quickRefresh)
+            timings["fetchSec"], phaseStart = time.perf_counter() - phaseStart, time.perf_counter()
 
-    def updateAllStocks(self):
+            self._recordPriceHistory(fetchedDetails, liveTickers)
+            timings["priceHistorySec"], phaseStart = time.perf_counter() - phaseStart, time.perf_counter()
 
-        startTime = datetime.now(pytz.timezone('Europe/Stockholm'))
-        print(f"\n{startTime} - Updating all stocks")
-        self.reinitializeAllVariables()
-        myStocks = self.fileHandler.readAssetsFromMongo()
-        self.lastRefreshedTime = int(time.time())
+            decisions = self._evaluatePortfolio(marketStocks, fetchedDetails)
+
+            for nextStock, stockData in marketStocks.items():
+                self._replaceContribution(nextStock, self._evaluateStock(nextStock, stockData, fetchedDetails, decisions))
+            timings["evaluateSec"], phaseStart = time.perf_counter() - phaseStart, time.perf_counter()
+
+            self._publishSnapshot()
+            timings["publishSec"] = time.perf_counter() - phaseStart
+            timings["totalSec"] = sum(timings.values())
+            timings["tickers"] = len(marketStocks)
+            self.lastCycleTimings = timings
+
+            print(f"{datetime.now(pytz.timezone('Europe/Stockholm'))} - Done! updating {len(marketStocks)} stocks   (Took: {(datetime.now(pytz.timezone('Europe/Stockholm')) - startTime).total_seconds():.2f}s)\n")
+
+    def _recordPriceHistory(self, fetchedDetails, liveTickers):
+        # Prices served from the fetchers cache (locked tickers, quick refreshes) may be
+        # hours old, only the ones fetched in this cycle belong in the history
+
+        if self.priceHistory is None:
+            return
+
+        try:
+            self.priceHistory.append(time.time(), {ticker: details for ticker, details in fetchedDetails.items()
+                                                   if ticker in liveTickers and not isinstance(details, Exception)})
+        except Exception as ex:
+            print(f"Could not record price history ({ex})")
+
+    def _evaluatePortfolio(self, myStocks, fetchedDetails):
+        """
+        Asks the strategy in Analyze about every ticker that was fetched, in one call.
+        Returns ticker -> (numberToBuy, numberToSell, buyIndication).
+        """
+        tickers = []
+        inputs = []
 
         for nextStock, stockData in myStocks.items():
+            stockDetails = fetchedDetails.get(nextStock)
+            if stockDetails is None or isinstance(stockDetails, Exception):
+                continue
+
             try:
-                if not self.marketOpenHours.isMarketOpen(nextStock):
-                    self.skippedCounter = self.skippedCounter + 1 if stockData['count'] > 0 else self.skippedCounter
-                    continue
+                valueSek, boughtAt, soldAt, switchedAt, transactionMode, _ = PortfolioState.tradingInputs(stockData, stockDetails['price_in_sek'])
+                inputs.append((valueSek, stockDetails['price_in_sek'], stockDetails['price'], boughtAt, soldAt, switchedAt,
+                               int(transactionMode), stockData['totalInvestedSek']))
+                tickers.append(nextStock)
+            except Exception:
+                # _evaluateStock reports the ticker as failed
+                pass
+
+        if len(tickers) == 0:
+            return {}
 
-                stockDetails = self.fetcher.fetchTickerInfo(nextStock, stockData['currency'],
-                                                            useCacheForDynamics=((stockData['lockKey'] > 0) or self.QUICK_REFRESH),
-                                                            getStaticData=False)
-                stockOwnName = stockData['name']
-                valueSek = int(stockDetails['price_in_sek'] * stockData['count'])
-                stockData['tickerIsLocked'] = True if stockData['lockKey'] > 0 else False
-                stockData['lockKey'] = -1
-
-                soldAt = 10000000
-                boughtAt = 0
-                switchedAt = 0
-                transactionMode = Analyze.TransactionMode.Neutral
-
-                if 'soldAt' in stockData and stockData['soldAt']:
-                    soldAt = stockData['soldAt']
-                    switchedAt = soldAt
-                if 'boughtAt' in stockData and stockData['boughtAt']:
-                    boughtAt = stockData['boughtAt']
-                    switchedAt = boughtAt
-
-                if stockData['count'] > 0 and stockData['boughtAt'] is None and stockData['soldAt'] is not None:
-                    self.sellModeStocks += 1
-                    transactionMode = Analyze.TransactionMode.Sell
-                if stockData['count'] > 0 and stockData['boughtAt'] is not None and stockData['soldAt'] is None:
-                    self.buyModeStocks += 1
-                    transactionMode = Analyze.TransactionMode.Buy
-                if stockData['count'] > 0 and stockData['boughtAt'] is None and stockData['soldAt'] is None:
-                    self.neutralModeStocks += 1
-                    transactionMode = Analyze.TransactionMode.Neutral
-                if "switchedAt" in stockData:
-                    switchedAt = stockData["switchedAt"]
-
-                stockCountToSell = Analyze.howManyToSell(nextStock, valueSek, stockDetails['price_in_sek'], stockDetails['price'], boughtAt, soldAt, switchedAt, transactionMode)
-
-                if stockData['count'] > 0 and stockCountToSell > 0:
-                    self.stocksToSell['list'].append({"tickerName": nextStock, "currentStock": stockData, "numberToSell": stockCountToSell,
+        try:
+            columns = [np.array([np.nan if value is None else value for value in column], dtype=np.float64) for column in zip(*inputs)]
+            columns[6] = columns[6].astype(np.int64)
+            numberToBuy, numberToSell, buyIndication = PortfolioState.evaluatePortfolio(tickers, *columns)
+        except Exception as ex:
+            print(f"Analyze failed ({ex})")
+            return {}
+
+        return {ticker: (int(numberToBuy[i]), int(numberToSell[i]), float(buyIndication[i])) for i, ticker in enumerate(tickers)}
+
+    def _evaluateStock(self, nextStock, stockData, fetchedDetails, decisions):
+        """
+        Works out what one ticker adds to the published documents. Nothing in here
+        touches the totals, _replaceContribution does that.
+        """
+        contribution = {totalName: 0 for totalName in self.TOTAL_NAMES}
+        contribution.update({"allStocksEntry": None, "buyEntry": None, "sellEntry": None, "industry": None,
+                             "companyName": None, "failedName": None})
+
+        try:
+            if nextStock not in fetchedDetails:
+                contribution["skippedCounter"] = 1 if stockData['count'] > 0 else 0
+                return contribution
+
+            stockDetails = fetchedDetails[nextStock]
+            if isinstance(stockDetails, Exception):
+                raise stockDetails
+
+            if nextStock not in decisions:
+                raise RuntimeError(f"No decision from Analyze for {nextStock}")
+
+            stockOwnName = stockData['name']
+            valueSek, _, _, _, _, modeCounter = PortfolioState.tradingInputs(stockData, stockDetails['price_in_sek'])
+            numberStocksToBuy, stockCountToSell, buyIndication = decisions[nextStock]
+            stockData['tickerIsLocked'] = True if stockData['lockKey'] > 0 else False
+            stockData['lockKey'] = -1
+
+            if stockData['count'] > 0 and stockCountToSell > 0:
+                contribution["sellEntry"] = {"tickerName": nextStock, "currentStock": stockData, "numberToSell": stockCountToSell,
+                                             "singleStockPriceSek": stockDetails['price_in_sek'],
+                                             "priceOrigCurrancy": stockDetails['price'], "currancy": stockData['currency']}
+
+            if stockData['count'] > 0 and numberStocksToBuy > 0:
+                contribution["buyEntry"] = {"tickerName": nextStock, "currentStock": stockData, "buyIndication": buyIndication,
+                                            "numberToBuy": numberStocksToBuy, "singleStockPriceSek": stockDetails['price_in_sek'],
+                                            "priceOrigCurrancy": stockDetails['price'], "currancy": stockData['currency']}
+
+            if modeCounter is not None:
+                contribution[modeCounter] = 1
+            contribution["totalEmployees"] = stockDetails["employees"]
+            contribution["industry"] = self.industryConverter(stockDetails["industry"])
+            contribution["companyName"] = stockOwnName
+            contribution["totalGlobalValueSek"] = valueSek
+            contribution["totalInvestedSek"] = stockData["totalInvestedSek"]
+
+            contribution["allStocksEntry"] = {"tickerName": nextStock, "currentStock": stockData,
                                               "singleStockPriceSek": stockDetails['price_in_sek'],
-                                              "priceOrigCurrancy": stockDetails['price'], "currancy": stockData['currency']})
+                                              "priceOrigCurrancy": stockDetails['price'], "currancy": stockData['currency'],
+                                              }
+
+            if stockData['count'] > 0:
+                contribution["successCounter"] = 1
+
+            if "manualOverridePriceSek" in stockData:
+                print(f"Warning: You have a manual override price for a stock that is available online! {stockOwnName}")
+
+        except Exception as ex:
+
+            contribution = {totalName: 0 for totalName in self.TOTAL_NAMES}
+            contribution.update({"allStocksEntry": None, "buyEntry": None, "sellEntry": None, "industry": None,
+                                 "companyName": None, "failedName": stockData["name"], "failCounter": 1})
+
+            if "manualOverridePriceSek" in stockData:
+                print(f"Using manual override price for {stockData['name']}")
+                contribution["totalGlobalValueSek"] = int(stockData["manualOverridePriceSek"] * stockData['count'])
+            else:
+                print(f"Could not get stock data: {stockData['name']}  ({ex})")
+
+        finally:
+            sys.stdout.flush()
+
+        return contribution
 
-                numberStocksToBuy = Analyze.howManyToBuy(nextStock, valueSek, stockDetails['price_in_sek'], stockDetails['price'], boughtAt, soldAt, switchedAt, transactionMode)
-                if stockData['count'] > 0 and numberStocksToBuy > 0:
-                    buyIndication = Analyze.getBuyIndication(valueSek, stockData["totalInvestedSek"])
-                    self.stocksToBuy['list'].append({"tickerName": nextStock, "currentStock": stockData, "buyIndication": buyIndication,
-                                             "numberToBuy": numberStocksToBuy, "singleStockPriceSek": stockDetails['price_in_sek'],
-                                             "priceOrigCurrancy": stockDetails['price'], "currancy": stockData['currency']})
+    def _replaceContribution(self, ticker, contribution):
+        """
+        Subtracts the old contribution of ticker from the totals and industries and
+        adds the new one. A contribution of None removes the ticker.
+        """
+        oldContribution = self.tickerContributions.pop(ticker, None)
 
-                self.totalEmployees += stockDetails["employees"]
+        if oldContribution is not None:
+            for totalName in self.TOTAL_NAMES:
+                self.totals[totalName] -= oldContribution[totalName]
 
-                industry = self.industryConverter(stockDetails["industry"])
+            industry = oldContribution["industry"]
+            if industry is not None:
+                self.industries[industry]["totValue (SEK)"] -= oldContribution["totalGlobalValueSek"]
+                self.industries[industry]["companies"].remove(oldContribution["companyName"])
+                if len(self.industries[industry]["companies"]) == 0:
+                    del(self.industries[industry])
 
+        if contribution is not None:
+            for totalName in self.TOTAL_NAMES:
+                self.totals[totalName] += contribution[totalName]
+
+            industry = contribution["industry"]
+            if industry is not None:
                 if industry not in self.industries:
                     self.industries[industry] = \
                         {
@@ -153,75 +327,130 @@ class MainStockWatcher:
                             "companies": []
                         }
 
-                self.industries[industry]["totValue (SEK)"] += valueSek
-                self.industries[industry]["companies"].append(stockOwnName)
+                self.industries[industry]["totValue (SEK)"] += contribution["totalGlobalValueSek"]
+                self.industries[industry]["companies"].append(contribution["companyName"])
 
-                self.totalGlobalValue += valueSek
-                self.totalInvested += stockData["totalInvestedSek"]
+            self.tickerContributions[ticker] = contribution
 
-                self.allStocks["list"].append({"tickerName": nextStock, "currentStock": stockData,
-                                               "singleStockPriceSek": stockDetails['price_in_sek'],
-                                               "priceOrigCurrancy": stockDetails['price'], "currancy": stockData['currency'],
-                                               })
+    def _publishSnapshot(self):
 
-                if stockData['count'] > 0:
-                    self.successCounter += 1
+        contributions = [self.tickerContributions[ticker] for ticker in self.tickerOrder if ticker in self.tickerContributions]
 
-                if "manualOverridePriceSek" in stockData:
-                    print(f"Warning: You have a manual override price for a stock that is available online! {stockOwnName}")
+        topData = {}
+        topData['updatedUtc'] = str(datetime.now(pytz.timezone('Europe/Stockholm')))
+        topData['sellModeStocks'] = self.totals["sellModeStocks"]
+        topData['buyModeStocks'] = self.totals["buyModeStocks"]
+        topData['neutralModeStocks'] = self.totals["neutralModeStocks"]
+        topData['failCounter'] = self.totals["failCounter"]
+        topData['successCounter'] = self.totals["successCounter"]
+        topData['skippedCounter'] = self.totals["skippedCounter"]
+        topData['totalInvestedSek'] = self.totals["totalInvestedSek"]
+        topData['totalGlobalValueSek'] = self.totals["totalGlobalValueSek"]
+        topData['updateVersion'] = math.floor(math.fabs(random.randint(1000000, 1000000000)))
+        topData['stale'] = False
 
-            except Exception as ex:
+        stocksToBuy = {"list": [contribution["buyEntry"] for contribution in contributions if contribution["buyEntry"] is not None], **topData}
+        stocksToSell = {"list": [contribution["sellEntry"] for contribution in contributions if contribution["sellEntry"] is not None], **topData}
+        allStocks = {"list": [contribution["allStocksEntry"] for contribution in contributions if contribution["allStocksEntry"] is not None], **topData}
 
-                if "manualOverridePriceSek" in stockData:
-                    print(f"Using manual override price for {stockData['name']}")
-                    self.totalGlobalValue += int(stockData["manualOverridePriceSek"] * stockData['count'])
-                else:
-                    print(f"Could not get stock data: {stockData['name']}  ({ex})")
+        stocksToBuy['list'] = sorted(stocksToBuy['list'], key=lambda i: i['buyIndication'], reverse=True)
+        allStocks["industries"] = {k: {"totValue (SEK)": v["totValue (SEK)"], "companies": list(v["companies"])}
+                                   for k, v in sorted(self.industries.items(), key=lambda item: item[1]["totValue (SEK)"])}
 
-                self.failedToLookup.append(stockData["name"])
+        self.snapshot = Snapshot.Snapshot(allStocks, stocksToBuy, stocksToSell)
+        self.snapshotHistory.append(self.snapshot)
+        self._notifyPublishListeners(self.snapshot)
 
-            finally:
-                sys.stdout.flush()
+        self._persistSnapshot()
 
-        self.QUICK_REFRESH = False
-        topData = {}
-        topData['updatedUtc'] = str(datetime.now(pytz.timezone('Europe/Stockholm')))
-        topData['sellModeStocks'] = self.sellModeStocks
-        topData['buyModeStocks'] = self.buyModeStocks
-        topData['neutralModeStocks'] = self.neutralModeStocks
-        topData['failCounter'] = len(self.failedToLookup)
-        topData['successCounter'] = self.successCounter
-        topData['skippedCounter'] = self.skippedCounter
-        topData['totalInvestedSek'] = self.totalInvested
-        topData['totalGlobalValueSek'] = self.totalGlobalValue
-        topData['updateVersion'] = math.floor(math.fabs(random.randint(1000000, 1000000000)))
+    def _loadPersistedSnapshot(self):
+
+        if self.snapshotPath is None or not os.path.exists(self.snapshotPath):
+            return
+
+        try:
+            with open(self.snapshotPath) as snapshotFile:
+                snapshot = json.load(snapshotFile)
+
+            for documentName in ("allStocks", "stocksToBuy", "stocksToSell"):
+                snapshot[documentName]["stale"] = True
 
-        self.stocksToBuy = {**self.stocksToBuy, **topData}
-        self.stocksToSell = {**self.stocksToSell, **topData}
+            self.snapshot = Snapshot.Snapshot(snapshot["allStocks"], snapshot["stocksToBuy"], snapshot["stocksToSell"])
 
-        self.stocksToBuy['list'] = sorted(self.stocksToBuy['list'], key=lambda i: i['buyIndication'], reverse=True)
-        self.industries = {k: v for k, v in sorted(self.industries.items(), key=lambda item: item[1]["totValue (SEK)"])}
+            print(f"Serving stale snapshot from {self.snapshotPath} (updated {self.snapshot.allStocks.get('updatedUtc')}) until the first refresh is done")
+        except Exception as ex:
+            print(f"Could not load persisted snapshot {self.snapshotPath} ({ex})")
 
-        self.allStocks = {**self.allStocks, **topData}
-        self.allStocks["industries"] = self.industries
+    def _persistSnapshot(self):
 
-        with self.globalLock:
-            self.cachedStocksToBuy = copy.deepcopy(self.stocksToBuy)
-            self.cachedStocksToSell = copy.deepcopy(self.stocksToSell)
-            self.cachedAllStocks = copy.deepcopy(self.allStocks)
+        if self.snapshotPath is None:
+            return
+
+        try:
+            snapshot = self.snapshot
+            snapshotJson = json.dumps({"allStocks": snapshot.allStocks, "stocksToBuy": snapshot.stocksToBuy, "stocksToSell": snapshot.stocksToSell})
+
+            tempPath = self.snapshotPath + ".tmp"
+            with open(tempPath, "w") as snapshotFile:
+                snapshotFile.write(snapshotJson)
+            os.replace(tempPath, self.snapshotPath)
+        except Exception as ex:
+            print(f"Could not persist snapshot to {self.snapshotPath} ({ex})")
+
+    def _fetchAllStockDetails(self, myStocks, quickRefresh=False):
+        # Returns (fetchedDetails, the set of tickers whose price was fetched live)
+
+        cachedTickers = []
+        liveTickers = []
+        invalidTickers = {}
+        now = time.time()
+
+        for nextStock, stockData in myStocks.items():
+            try:
+                if not self.marketOpenHours.isMarketOpen(nextStock, now):
+                    continue
+
+                if (stockData['lockKey'] > 0) or quickRefresh:
+                    cachedTickers.append((nextStock, stockData['currency']))
+                else:
+                    liveTickers.append((nextStock, stockData['currency']))
+            except Exception as ex:
+                # i.e. an asset without currency, _evaluateStock reports it as failed
+                invalidTickers[nextStock] = ex
+
+        fetchedDetails = self.fetcher.fetchTickerInfoBatch(cachedTickers, useCacheForDynamics=True, getStaticData=False, executor=self.fetchPool)
+        fetchedDetails.update(self.fetcher.fetchTickerInfoBatch(liveTickers, useCacheForDynamics=False, getStaticData=False, executor=self.fetchPool))
+        fetchedDetails.update(invalidTickers)
+
+        return fetchedDetails, {ticker for ticker, _ in liveTickers}
+
+    def addPublishListener(self, listener):
+        self.publishListeners.append(listener)
+
+    def _notifyPublishListeners(self, snapshot):
+
+        for listener in self.publishListeners:
+            try:
+                listener(snapshot)
+            except Exception as ex:
+                print(f"Publish listener failed ({ex})")
 
-        self.NEXT_REFRESH_INTERVAL_SEC = random.randint(self.MIN_REFRESH_INTERVAL_SEC, self.MAX_REFRESH_INTERVAL_SEC)
+    def getCycleTimings(self):
+        return dict(self.lastCycleTimings)
 
-        print(f"{datetime.now(pytz.timezone('Europe/Stockholm'))} - Done! updating all stocks   (Took: {(datetime.now(pytz.timezone('Europe/Stockholm')) - startTime).total_seconds():.2f}s)\n")
+    def getSnapshot(self):
+        return self.snapshot
 
-    def getStocksToBuyAsList(self):
-        with self.globalLock:
-            return copy.deepcopy(self.cachedStocksToBuy)
+    def getAllStocksDelta(self, sinceVersion):
+        """
+        Returns the changes in allStocks since the snapshot with updateVersion
+        sinceVersion, or None if that snapshot is no longer in the history and
+        the client has to resync with the full document.
+        """
+        snapshot = self.snapshot
 
-    def getStocksToSellAsList(self):
-        with self.globalLock:
-            return copy.deepcopy(self.cachedStocksToSell)
+        for olderSnapshot in list(self.snapshotHistory):
+            if olderSnapshot.updateVersion == sinceVersion:
+                return snapshot.deltaSince(olderSnapshot)
 
-    def getAllStocks(self):
-        with self.globalLock:
-            return copy.deepcopy(self.cachedAllStocks)
+        return None
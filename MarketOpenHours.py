@@ -1,5 +1,52 @@
+import os
+import json
+import time
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
+
+HOLIDAYS_FILE = os.getenv('TP_HOLIDAYS_FILE')
+
+class HolidayCalendar:
+    """
+    Exchange holidays and half days, read from a json file like
+    {".ST": {"2026-12-24": null, "2026-12-30": {"close": [13, 0]}}}
+    where null means closed all day and an object overrides "open" and/or "close"
+    for that day. Dates are local to the market. Anything with a
+    session(market, day, openTime, closeTime) method can be used instead.
+    """
+
+    def __init__(self, days=None):
+        self.days = days if days is not None else {}
+
+    @classmethod
+    def load(cls, path):
+
+        if path is None:
+            return cls()
+
+        try:
+            with open(path) as holidaysFile:
+                return cls(json.load(holidaysFile))
+        except Exception as ex:
+            print(f"Could not load holidays from {path} ({ex})")
+            return cls()
+
+    def session(self, market, day, openTime, closeTime):
+        """
+        Returns the (open, close) times of market on day, or None if it is closed.
+        """
+        marketDays = self.days.get(market, {})
+        isoDay = day.isoformat()
+
+        if isoDay not in marketDays:
+            return openTime, closeTime
+
+        override = marketDays[isoDay]
+        if override is None:
+            return None
+
+        return tuple(override.get("open", openTime)), tuple(override.get("close", closeTime))
+
 
 class MarketOpenHours:
     MARKET_OPEN_HOURS = {
@@ -15,28 +62,55 @@ class MarketOpenHours:
         ".TO": {"in": True, "open": (9, 45), "close": (15, 57), "timezone": "US/Eastern"},       # 15 / RT
         ".": {"in": False, "open": (9, 45), "close": (15, 57), "timezone": "US/Eastern"}         # 15 / RT
     }
+    MAX_DAYS_TO_NEXT_SESSION = 14
 
-    def __init__(self):
+    def __init__(self, holidayCalendar=None):
         self.marketOpenHash = 0
-
-    def isTimeWithin(self, openTime, closeTime, timezone):
-
-        currentDate = datetime.now(pytz.timezone(timezone))
-        currentHour = currentDate.hour
-        currentMinute = currentDate.minute
-
-        if (((currentHour > openTime[0]) or (currentHour == openTime[0] and currentMinute >= openTime[1])) and \
-                ((currentHour < closeTime[0]) or (currentHour == closeTime[0] and currentMinute < closeTime[1]))):
-            return True
-        else:
-            return False
+        self.holidayCalendar = holidayCalendar if holidayCalendar is not None else HolidayCalendar.load(HOLIDAYS_FILE)
+        self.tickerMarkets = {}
+        self.marketSessions = {}
+
+    def _session(self, market, now):
+        """
+        Returns the (open, close) epoch seconds of the current or next trading
+        session of market. Sessions are worked out once per trading day, after
+        that the check is only a comparison.
+        """
+        session = self.marketSessions.get(market)
+        if session is not None and now < session[1]:
+            return session
+
+        value = self.MARKET_OPEN_HOURS[market]
+        timezone = pytz.timezone(value["timezone"])
+        today = datetime.fromtimestamp(now, timezone).date()
+        session = (float("inf"), float("inf"))
+
+        for dayOffset in range(self.MAX_DAYS_TO_NEXT_SESSION):
+            day = today + timedelta(days=dayOffset)
+            if day.weekday() > 4:
+                continue
+
+            times = self.holidayCalendar.session(market, day, value["open"], value["close"])
+            if times is None:
+                continue
+
+            (openHour, openMinute), (closeHour, closeMinute) = times
+            openTs = timezone.localize(datetime(day.year, day.month, day.day, openHour, openMinute)).timestamp()
+            closeTs = timezone.localize(datetime(day.year, day.month, day.day, closeHour, closeMinute)).timestamp()
+            if now < closeTs:
+                session = (openTs, closeTs)
+                break
+
+        self.marketSessions[market] = session
+        return session
 
     def marketsOpenedOrClosed(self):
 
+        now = time.time()
         stringValue = ""
 
-        for key, value in self.MARKET_OPEN_HOURS.items():
-            stringValue += f"{self.isTimeWithin(value['open'], value['close'], value['timezone'])}"
+        for key in self.MARKET_OPEN_HOURS.keys():
+            stringValue += f"{self.isMarketKeyOpen(key, now)}"
 
         newHash = hash(stringValue)
 
@@ -47,21 +121,56 @@ class MarketOpenHours:
         else:
             return False
 
-    def isMarketOpen(self, ticker):
+    def nextTransition(self):
+        """
+        Returns the next instant, as an aware datetime, at which any market in
+        MARKET_OPEN_HOURS opens or closes.
+        """
+        now = time.time()
+        transitions = []
 
-        if not self.isWeekday():
-            return False
+        for key in self.MARKET_OPEN_HOURS.keys():
+            openTs, closeTs = self._session(key, now)
+            transitions.append(openTs if now < openTs else closeTs)
+
+        return datetime.fromtimestamp(min(transitions), pytz.utc)
+
+    def getMarkets(self):
+        """
+        All market keys, plus None for tickers that match no market.
+        """
+        return list(self.MARKET_OPEN_HOURS.keys()) + [None]
+
+    def getMarket(self, ticker):
 
+        if ticker in self.tickerMarkets:
+            return self.tickerMarkets[ticker]
+
+        market = None
         for key, value in self.MARKET_OPEN_HOURS.items():
-            if value["in"]:
-                if key in ticker:
-                    return self.isTimeWithin(value["open"], value["close"], value["timezone"])
-            else:
-                if key not in ticker:
-                    return self.isTimeWithin(value["open"], value["close"], value["timezone"])
+            if value["in"] == (key in ticker):
+                market = key
+                break
+
+        if market is None:
+            print(f"Open hours for ticker {ticker} not found")
+
+        self.tickerMarkets[ticker] = market
+        return market
+
+    def isMarketKeyOpen(self, market, now=None):
+
+        if now is None:
+            now = time.time()
+
+        if market is None:
+            return self.isWeekday()
+
+        openTs, closeTs = self._session(market, now)
+        return openTs <= now < closeTs
 
-        print(f"Open hours for ticker {ticker} not found")
-        return True
+    def isMarketOpen(self, ticker, now=None):
+        return self.isMarketKeyOpen(self.getMarket(ticker), now)
 
     def isWeekday(self):
         return datetime.now(pytz.timezone('Europe/Stockholm')).weekday() <= 4
@@ -73,4 +182,5 @@ if __name__ == "__main__":
     print(f"T open {m.isMarketOpen('T')}")
     print(f"opened or closed {m.marketsOpenedOrClosed()}")
     print(f"opened or closed {m.marketsOpenedOrClosed()}")
-    print(f"is weekday {m.isWeekday()}")
\ No newline at end of file
+    print(f"is weekday {m.isWeekday()}")
+    print(f"next transition {m.nextTransition()}")
@@ -0,0 +1,95 @@
+import enum
+import math
+import numpy as np
+
+#
+# Portfolio state. Not part of the strategy, Analyze.py is yours to replace, but
+# shared by MainStockWatcher, RestServer and Backtest so that they all derive the
+# same inputs, call the strategy the same way and apply trades the same way.
+#
+
+class TransactionMode(enum.IntEnum):
+    Neutral = 0
+    Buy = 1
+    Sell = 2
+
+def tradingInputs(stockData, singleStockPriceSek):
+    # Returns (valueSek, boughtAt, soldAt, switchedAt, transactionMode, modeCounter)
+    valueSek = int(singleStockPriceSek * stockData['count'])
+    soldAt = 10000000
+    boughtAt = 0
+    switchedAt = 0
+    transactionMode = TransactionMode.Neutral
+    modeCounter = None
+
+    if 'soldAt' in stockData and stockData['soldAt']:
+        soldAt = stockData['soldAt']
+        switchedAt = soldAt
+    if 'boughtAt' in stockData and stockData['boughtAt']:
+        boughtAt = stockData['boughtAt']
+        switchedAt = boughtAt
+
+    if stockData['count'] > 0 and stockData['boughtAt'] is None and stockData['soldAt'] is not None:
+        modeCounter = "sellModeStocks"
+        transactionMode = TransactionMode.Sell
+    if stockData['count'] > 0 and stockData['boughtAt'] is not None and stockData['soldAt'] is None:
+        modeCounter = "buyModeStocks"
+        transactionMode = TransactionMode.Buy
+    if stockData['count'] > 0 and stockData['boughtAt'] is None and stockData['soldAt'] is None:
+        modeCounter = "neutralModeStocks"
+        transactionMode = TransactionMode.Neutral
+    if "switchedAt" in stockData:
+        switchedAt = stockData["switchedAt"]
+
+    return valueSek, boughtAt, soldAt, switchedAt, transactionMode, modeCounter
+
+def checkMadeTheSwitch(oldTradeVal, newTradeVal, currentSwitchValue):
+
+    if oldTradeVal == None and newTradeVal is not None:
+        return newTradeVal
+    else:
+        return currentSwitchValue
+
+def updateTradeValue(stockData, tradeKey, newTradeVal):
+    # Sets boughtAt or soldAt, and moves switchedAt when the ticker switches mode
+    newSwitchValue = stockData["switchedAt"] if "switchedAt" in stockData else None
+
+    if tradeKey in stockData:
+        newSwitchValue = checkMadeTheSwitch(stockData[tradeKey], newTradeVal, newSwitchValue)
+
+    stockData["switchedAt"] = newSwitchValue
+    stockData[tradeKey] = newTradeVal
+
+# #########################################################################
+# Asks the strategy about the whole portfolio, with the arguments of
+# Analyze.evaluatePortfolio. An Analyze.py without evaluatePortfolio is
+# called once per ticker through its scalar functions instead.
+# #########################################################################
+def evaluatePortfolio(tickerNames, totalStockValues, singleStockPricesSek, singleStockPricesOrigCurr, bougthAtOrigiCurr, soldAtOrigCurr, switchedAt, transactionModes, investedTot):
+    # Imported here, Analyze imports TransactionMode from this module
+    import Analyze
+
+    if hasattr(Analyze, "evaluatePortfolio"):
+        return Analyze.evaluatePortfolio(tickerNames, totalStockValues, singleStockPricesSek, singleStockPricesOrigCurr,
+                                         bougthAtOrigiCurr, soldAtOrigCurr, switchedAt, transactionModes, investedTot)
+
+    strategyModes = getattr(Analyze, "TransactionMode", TransactionMode)
+    tickerCount = len(tickerNames)
+    numberToBuy = np.zeros(tickerCount, dtype=np.int64)
+    numberToSell = np.zeros(tickerCount, dtype=np.int64)
+    buyIndication = np.zeros(tickerCount, dtype=np.float64)
+
+    for i, tickerName in enumerate(tickerNames):
+        scalarArgs = (tickerName, _scalar(totalStockValues[i]), _scalar(singleStockPricesSek[i]), _scalar(singleStockPricesOrigCurr[i]),
+                      _scalar(bougthAtOrigiCurr[i]), _scalar(soldAtOrigCurr[i]), _scalar(switchedAt[i]),
+                      strategyModes[TransactionMode(int(transactionModes[i])).name])
+        numberToBuy[i] = Analyze.howManyToBuy(*scalarArgs)
+        numberToSell[i] = Analyze.howManyToSell(*scalarArgs)
+        buyIndication[i] = Analyze.getBuyIndication(_scalar(totalStockValues[i]), _scalar(investedTot[i]))
+
+    return numberToBuy, numberToSell, buyIndication
+
+def _scalar(value):
+    # The batch arguments carry None as NaN, the scalar functions always got None
+    value = float(value)
+    return None if math.isnan(value) else value
@@ -0,0 +1,101 @@
+import os
+import math
+import time
+import threading
+import numpy as np
+from urllib.parse import quote, unquote
+
+HISTORY_DIRECTORY = os.getenv('TP_HISTORY_DIR')
+
+RECORD_TYPE = np.dtype([('timestamp', '<f8'), ('price', '<f8'), ('price_in_sek', '<f8'), ('convertToSekRatio', '<f8')])
+
+class PriceHistory:
+    """
+    Every fetched price, kept as one append-only file of fixed size records per
+    ticker. Records are appended in time order, so a file is its own time index:
+    a range query memory maps the file and binary searches the timestamps, and
+    only the pages holding the requested range are ever read.
+    """
+
+    MAX_POINTS = 10000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.lastTimestamps = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, ticker):
+        return os.path.join(self.directory, quote(ticker, safe='') + ".bin")
+
+    def tickers(self):
+        return [unquote(fileName[:-len(".bin")]) for fileName in os.listdir(self.directory) if fileName.endswith(".bin")]
+
+    def append(self, timestamp, tickerDetails):
+        """
+        Appends one record per ticker. tickerDetails maps a ticker to a dict with
+        price, price_in_sek and convertToSekRatio, like fetchTickerInfo returns.
+        """
+        with self.lock:
+            for ticker, details in tickerDetails.items():
+                if timestamp <= self._lastTimestamp(ticker):
+                    continue
+
+                record = np.array([(timestamp, details['price'], details['price_in_sek'], details['convertToSekRatio'])], dtype=RECORD_TYPE)
+                with open(self._path(ticker), 'ab') as historyFile:
+                    historyFile.write(record.tobytes())
+                self.lastTimestamps[ticker] = timestamp
+
+    def _lastTimestamp(self, ticker):
+
+        if ticker not in self.lastTimestamps:
+            records = self.records(ticker)
+            self.lastTimestamps[ticker] = float(records['timestamp'][-1]) if len(records) > 0 else 0.0
+
+        return self.lastTimestamps[ticker]
+
+    def records(self, ticker):
+        """
+        Returns all records of ticker as a read-only structured array of
+        RECORD_TYPE, memory mapped and without the MAX_POINTS cap of query.
+        """
+        path = self._path(ticker)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=RECORD_TYPE)
+
+        # A record that is being appended right now is not complete yet, leave it out
+        count = os.path.getsize(path) // RECORD_TYPE.itemsize
+        if count == 0:
+            return np.empty(0, dtype=RECORD_TYPE)
+
+        return np.memmap(path, dtype=RECORD_TYPE, mode='r', shape=(count,))
+
+    def query(self, ticker, fromTimestamp=0.0, toTimestamp=None, step=0):
+        """
+        Returns the records of ticker with fromTimestamp <= timestamp < toTimestamp
+        as columns. With a step (seconds) only the last record of every step long
+        bucket is returned. If the range holds more than MAX_POINTS records, step is
+        raised so that it does not.
+        """
+        toTimestamp = time.time() if toTimestamp is None else toTimestamp
+        records = self.records(ticker)
+        timestamps = records['timestamp']
+
+        first, last = np.searchsorted(timestamps, [fromTimestamp, toTimestamp], side='left')
+        selected = records[first:last]
+
+        if len(selected) > self.MAX_POINTS:
+            step = max(step, math.ceil((selected['timestamp'][-1] - selected['timestamp'][0] + 1) / self.MAX_POINTS))
+
+        if step > 0 and len(selected) > 0:
+            buckets = np.floor_divide(selected['timestamp'], step)
+            lastInBucket = np.append(np.flatnonzero(np.diff(buckets)), len(selected) - 1)
+            selected = selected[lastInBucket]
+
+        return {
+            "ticker": ticker,
+            "from": fromTimestamp,
+            "to": toTimestamp,
+            "step": step,
+            **{column: selected[column].tolist() for column in RECORD_TYPE.names}
+        }
@@ -1,25 +1,55 @@
 
 from flask import Flask, request, Response
 import MainStockWatcher
-import threading
 import json
 import FileHandler
 import StocksFetcher
+import UpdateStream
+import HttpClient
+import PriceHistory
+import PortfolioState
 import random
 import math
 import copy
+import time
 import logging
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
 REFRESH_DELAY_SEC = 30
+MAX_CHANGE_LOG_ITEMS = 1000
+STARTUP_TIME = time.time()
 
 app = Flask(__name__)
-globalLock = threading.Lock()
-fileHandler = FileHandler.FileHandler()
-stocksFetcher = StocksFetcher.StocksFetcher()
-fileHandler.init()
-stockWatcher = MainStockWatcher.MainStockWatcher(fileHandler, stocksFetcher)
+fileHandler = None
+stocksFetcher = None
+priceHistory = None
+stockWatcher = None
+updateStream = None
+firstResponseServed = False
+
+def init(mongoClient=None, fetcher=None, marketOpenHours=None, startScheduler=True):
+    """
+    Wires up the services the endpoints use. The arguments are there so that
+    Benchmark.py can run the endpoints against local stand-ins.
+    """
+    global fileHandler, stocksFetcher, priceHistory, stockWatcher, updateStream
+
+    fileHandler = FileHandler.FileHandler()
+    stocksFetcher = fetcher if fetcher is not None else StocksFetcher.StocksFetcher()
+    priceHistory = None if PriceHistory.HISTORY_DIRECTORY is None else PriceHistory.PriceHistory(PriceHistory.HISTORY_DIRECTORY)
+    fileHandler.init(mongoClient)
+    stockWatcher = MainStockWatcher.MainStockWatcher(fileHandler, stocksFetcher, priceHistory=priceHistory,
+                                                     marketOpenHours=marketOpenHours, startScheduler=startScheduler)
+    updateStream = UpdateStream.UpdateStream(stockWatcher)
+
+@app.after_request
+def logTimeToFirstResponse(response):
+    global firstResponseServed
+    if not firstResponseServed:
+        firstResponseServed = True
+        print(f"First HTTP response served {time.time() - STARTUP_TIME:.2f}s after startup")
+    return response
 
 @app.route("/tradingpal")
 def index():
@@ -27,15 +57,32 @@ def index():
 
 @app.route("/tradingpal/getStocksToBuy", methods = ['GET'])
 def getStocksToBuy():
-    return json.dumps(stockWatcher.getStocksToBuyAsList(), indent=4)
+    snapshot = stockWatcher.getSnapshot()
+    return snapshotResponse(snapshot.stocksToBuyJson, snapshot)
 
 @app.route("/tradingpal/getStocksToSell", methods = ['GET'])
 def getStocksToSell():
-    return json.dumps(stockWatcher.getStocksToSellAsList(), indent=4)
+    snapshot = stockWatcher.getSnapshot()
+    return snapshotResponse(snapshot.stocksToSellJson, snapshot)
 
 @app.route("/tradingpal/getAllStocks", methods = ['GET'])
 def getAllStocks():
-    return json.dumps(stockWatcher.getAllStocks(), indent=4)
+    snapshot = stockWatcher.getSnapshot()
+    since = request.args.get("since")
+
+    if since is None:
+        return snapshotResponse(snapshot.allStocksJson, snapshot)
+
+    try:
+        since = int(since)
+    except ValueError:
+        return Response("since must be an integer updateVersion", status=400)
+
+    delta = stockWatcher.getAllStocksDelta(since)
+    if delta is None:
+        return snapshotResponse(snapshot.allStocksJson, snapshot)
+
+    return json.dumps(delta, indent=4)
 
 @app.route("/tradingpal/refresh", methods = ['PUT'])
 def refresh():
@@ -45,202 +92,165 @@ def refresh():
 
 @app.route("/tradingpal/lock", methods = ['POST'])
 def lockTicker():
-    with globalLock:
+    if request.data is None:
+        return Response("missing body", status=400)
 
-        if request.data is None:
-            return Response("missing body", status=400)
+    inputData = json.loads(request.data)
 
-        inputData = json.loads(request.data)
+    if "ticker" not in inputData:
+        return Response("please provide ticker to lock", status=400)
 
-        if "ticker" not in inputData:
-            return Response("please provide ticker to lock", status=400)
+    inputTickerName = inputData["ticker"]
 
-        file = fileHandler.readAssetsFromMongo()
-        inputTickerName = inputData["ticker"]
+    if fileHandler.readAsset(inputTickerName) is None:
+        print(f"Ticker not found: {inputTickerName}")
+        return Response("Ticker not found", status=400)
 
-        if inputTickerName not in file:
-            print(f"Ticker not found: {inputTickerName}")
-            return Response("Ticker not found", status=400)
+    lockKey = math.floor(math.fabs(random.randint(1000000, 1000000000)))
+    if not fileHandler.lockAsset(inputTickerName, lockKey):
+        print(f"Ticker already locked: {inputTickerName}")
+        return Response("Ticker already locked!", status=403)
 
-        fileTicker = file[inputTickerName]
-        if fileTicker["lockKey"] != 0:
-            print(f"Ticker already locked: {inputTickerName}")
-            return Response("Ticker already locked!", status=403)
-
-        lockKey = math.floor(math.fabs(random.randint(1000000, 1000000000)))
-        fileTicker["lockKey"] = lockKey
-        fileTicker["lockCounter"] = 0
-        fileHandler.writeAssetsToMongo(file)
-        stockWatcher.forceRefresh(QUICK_REFRESH=True)
-        return json.dumps({"lockKey": lockKey})
+    stockWatcher.forceRefresh(QUICK_REFRESH=True)
+    return json.dumps({"lockKey": lockKey})
 
 @app.route("/tradingpal/unlock", methods = ['POST'])
 def unlockTicker():
-    with globalLock:
-        if request.data is None:
-            return Response("missing body", status=400)
+    if request.data is None:
+        return Response("missing body", status=400)
 
-        inputData = json.loads(request.data)
+    inputData = json.loads(request.data)
 
-        if "ticker" not in inputData:
-            return Response("please provide ticker to unlock", status=400)
-        if "lockKey" not in inputData:
-            return Response("please provide lockKey", status=403)
+    if "ticker" not in inputData:
+        return Response("please provide ticker to unlock", status=400)
+    if "lockKey" not in inputData:
+        return Response("please provide lockKey", status=403)
 
-        file = fileHandler.readAssetsFromMongo()
-        inputTickerName = inputData["ticker"]
-        inputLockKey = inputData["lockKey"]
+    inputTickerName = inputData["ticker"]
+    inputLockKey = inputData["lockKey"]
 
-        if not isinstance(inputLockKey, (int)):
-            return Response("lockKey must be an integer", status=400)
+    if not isinstance(inputLockKey, (int)):
+        return Response("lockKey must be an integer", status=400)
 
-        if inputTickerName not in file:
+    if not fileHandler.unlockAsset(inputTickerName, inputLockKey):
+        fileTicker = fileHandler.readAsset(inputTickerName)
+        if fileTicker is None:
             return Response("Ticker not found", status=400)
-
-        fileTicker = file[inputTickerName]
         if fileTicker["lockKey"] == 0:
             return Response(status=200)
-        if fileTicker["lockKey"] != inputLockKey:
-            return Response("Wrong lockKey. Cannot unlock it!", status=403)
+        return Response("Wrong lockKey. Cannot unlock it!", status=403)
 
-        fileTicker["lockKey"] = 0
-        fileTicker["lockCounter"] = 0
-        fileHandler.writeAssetsToMongo(file)
-        stockWatcher.forceRefresh()
-        return Response(status=200)
+    stockWatcher.forceRefresh()
+    return Response(status=200)
 
 @app.route("/tradingpal", methods = ['DELETE'])
 def deleteTicker():
-    with globalLock:
-        if request.data is None:
-            return Response("missing body", status=400)
+    if request.data is None:
+        return Response("missing body", status=400)
 
-        inputData = json.loads(request.data)
+    inputData = json.loads(request.data)
 
-        if "ticker" not in inputData:
-            return Response("please provide ticker to delete", status=400)
-        if "lockKey" not in inputData:
-            return Response("please provide lockKey", status=403)
+    if "ticker" not in inputData:
+        return Response("please provide ticker to delete", status=400)
+    if "lockKey" not in inputData:
+        return Response("please provide lockKey", status=403)
 
-        file = fileHandler.readAssetsFromMongo()
-        inputTickerName = inputData["ticker"]
-        inputLockKey = inputData["lockKey"]
+    inputTickerName = inputData["ticker"]
+    inputLockKey = inputData["lockKey"]
 
-        if not isinstance(inputLockKey, (int)):
-            return Response("lockKey must be an integer", status=400)
+    if not isinstance(inputLockKey, (int)):
+        return Response("lockKey must be an integer", status=400)
 
-        if inputTickerName not in file:
+    if not fileHandler.deleteAsset(inputTickerName, inputLockKey):
+        if fileHandler.readAsset(inputTickerName) is None:
             return Response("Ticker not found", status=400)
+        return Response("Wrong lockKey. Cannot delete ticker!", status=403)
 
-        fileTicker = file[inputTickerName]
-        if fileTicker["lockKey"] != inputLockKey:
-            return Response("Wrong lockKey. Cannot delete ticker!", status=403)
-
-        del(file[inputTickerName])
-        fileHandler.writeAssetsToMongo(file)
-        stockWatcher.forceRefresh()
-        return Response(status=200)
+    stockWatcher.forceRefresh()
+    return Response(status=200)
 
 @app.route("/tradingpal/updateStock", methods = ['POST'])
 def updateStock():
 
-    with globalLock:
-
-        if request.data is None:
-            return Response("missing body", status=400)
-
-        inputData = json.loads(request.data)
-
-        tradedByBot = False
-        if "tradedByBot" in inputData:
-            tradedByBot = True
-
-        if "ticker" not in inputData:
-            return Response("please provide ticker", status=400)
-
-        fullMongoData = fileHandler.readAssetsFromMongo()
-        inputTickerName = inputData["ticker"]
-
-        if inputTickerName not in fullMongoData:
-            fullMongoData[inputTickerName] = {}
-
-        tickerInfoFromMongo = fullMongoData[inputTickerName]
-        copyOfTickerInfoFromMongo = copy.deepcopy(tickerInfoFromMongo)
-
-        if "lockKey" in tickerInfoFromMongo and tickerInfoFromMongo["lockKey"] == 0:
-            return Response("This ticker is not locked and can hence not be updated. Please lock it first", status=400)
-
-        if "lockKey" in inputData:
-            newValue = inputData["lockKey"]
-            if not isinstance(newValue, (int)):
-                return Response("lockKey must be int", status=400)
-            if "lockKey" in tickerInfoFromMongo and tickerInfoFromMongo["lockKey"] != newValue:
-                return Response("lockKey does not match!", status=403)
-            tickerInfoFromMongo["lockKey"] = 0
-            tickerInfoFromMongo["lockCounter"] = 0
-        else:
-            return Response("You need lockKey in order to update data", status=403)
-
-        if "boughtAt" in inputData:
-            newBoughtAtValue = inputData["boughtAt"]
-            if not isinstance(newBoughtAtValue, (int, float)) and newBoughtAtValue is not None:
-                return Response("boughtAt must be float, int or null", status=400)
-
-            if "switchedAt" in tickerInfoFromMongo:
-                newSwitchValue = tickerInfoFromMongo["switchedAt"]
-            else:
-                newSwitchValue = None
-
-            if "boughtAt" in tickerInfoFromMongo:
-                newSwitchValue = checkMadeTheSwitch(tickerInfoFromMongo["boughtAt"], newBoughtAtValue, newSwitchValue)
-
-            tickerInfoFromMongo["switchedAt"] = newSwitchValue
-            tickerInfoFromMongo["boughtAt"] = newBoughtAtValue
-        if "soldAt" in inputData:
-            newSoldAtValue = inputData["soldAt"]
-            if not isinstance(newSoldAtValue, (int, float)) and newSoldAtValue is not None:
-                return Response("soldAt must be float, int or null", status=400)
-
-            if "switchedAt" in tickerInfoFromMongo:
-                newSwitchValue = tickerInfoFromMongo["switchedAt"]
-            else:
-                newSwitchValue = None
-
-            if "soldAt" in tickerInfoFromMongo:
-                newSwitchValue = checkMadeTheSwitch(tickerInfoFromMongo["soldAt"], newSoldAtValue, newSwitchValue)
-
-            tickerInfoFromMongo["switchedAt"] = newSwitchValue
-            tickerInfoFromMongo["soldAt"] = newSoldAtValue
-        if "count" in inputData:
-            newValue = inputData["count"]
-            if not isinstance(newValue, (int)):
-                return Response("count must be int", status=400)
-            tickerInfoFromMongo["count"] = newValue
-        if "name" in inputData:
-            newValue = inputData["name"]
-            if not isinstance(newValue, (str)):
-                return Response("name must be string", status=400)
-            tickerInfoFromMongo["name"] = newValue
-        if "totalInvestedSek" in inputData:
-            newValue = inputData["totalInvestedSek"]
-            if not isinstance(newValue, (int)):
-                return Response("totalInvestedSek must be int", status=400)
-            tickerInfoFromMongo["totalInvestedSek"] = newValue
-
-        if "boughtAt" not in tickerInfoFromMongo: return Response("You did not provide a value for boughtAt", status=400)
-        if "count" not in tickerInfoFromMongo: return Response("You did not provide a value for count", status=400)
-        if "lockKey" not in tickerInfoFromMongo: return Response("You did not provide a value for lockKey", status=400)
-        if "name" not in tickerInfoFromMongo: return Response("You did not provide a value for name", status=400)
-        if "soldAt" not in tickerInfoFromMongo: return Response("You did not provide a value for soldAt", status=400)
-        if "totalInvestedSek" not in tickerInfoFromMongo: return Response("You did not provide a value for totalInvestedSek", status=400)
-
-        if tickerInfoFromMongo['boughtAt'] is not None and tickerInfoFromMongo['soldAt'] is not None:
-            return Response("At least one of soldAt or boughtAt must be null ")
-
-        fileHandler.writeAssetsToMongo(fullMongoData)
-        fileHandler.writeStockChangeLog(copyOfTickerInfoFromMongo, tickerInfoFromMongo, tradedByBot)
-        stockWatcher.forceRefresh()
-        return Response(status=200)
+    if request.data is None:
+        return Response("missing body", status=400)
+
+    inputData = json.loads(request.data)
+
+    tradedByBot = False
+    if "tradedByBot" in inputData:
+        tradedByBot = True
+
+    if "ticker" not in inputData:
+        return Response("please provide ticker", status=400)
+
+    inputTickerName = inputData["ticker"]
+    tickerInfoFromMongo = fileHandler.readAsset(inputTickerName)
+
+    if tickerInfoFromMongo is None:
+        tickerInfoFromMongo = {}
+
+    copyOfTickerInfoFromMongo = copy.deepcopy(tickerInfoFromMongo)
+
+    if "lockKey" in tickerInfoFromMongo and tickerInfoFromMongo["lockKey"] == 0:
+        return Response("This ticker is not locked and can hence not be updated. Please lock it first", status=400)
+
+    if "lockKey" in inputData:
+        newValue = inputData["lockKey"]
+        if not isinstance(newValue, (int)):
+            return Response("lockKey must be int", status=400)
+        if "lockKey" in tickerInfoFromMongo and tickerInfoFromMongo["lockKey"] != newValue:
+            return Response("lockKey does not match!", status=403)
+        tickerInfoFromMongo["lockKey"] = 0
+        tickerInfoFromMongo["lockCounter"] = 0
+    else:
+        return Response("You need lockKey in order to update data", status=403)
+
+    if "boughtAt" in inputData:
+        newBoughtAtValue = inputData["boughtAt"]
+        if not isinstance(newBoughtAtValue, (int, float)) and newBoughtAtValue is not None:
+            return Response("boughtAt must be float, int or null", status=400)
+
+        PortfolioState.updateTradeValue(tickerInfoFromMongo, "boughtAt", newBoughtAtValue)
+    if "soldAt" in inputData:
+        newSoldAtValue = inputData["soldAt"]
+        if not isinstance(newSoldAtValue, (int, float)) and newSoldAtValue is not None:
+            return Response("soldAt must be float, int or null", status=400)
+
+        PortfolioState.updateTradeValue(tickerInfoFromMongo, "soldAt", newSoldAtValue)
+    if "count" in inputData:
+        newValue = inputData["count"]
+        if not isinstance(newValue, (int)):
+            return Response("count must be int", status=400)
+        tickerInfoFromMongo["count"] = newValue
+    if "name" in inputData:
+        newValue = inputData["name"]
+        if not isinstance(newValue, (str)):
+            return Response("name must be string", status=400)
+        tickerInfoFromMongo["name"] = newValue
+    if "totalInvestedSek" in inputData:
+        newValue = inputData["totalInvestedSek"]
+        if not isinstance(newValue, (int)):
+            return Response("totalInvestedSek must be int", status=400)
+        tickerInfoFromMongo["totalInvestedSek"] = newValue
+
+    if "boughtAt" not in tickerInfoFromMongo: return Response("You did not provide a value for boughtAt", status=400)
+    if "count" not in tickerInfoFromMongo: return Response("You did not provide a value for count", status=400)
+    if "lockKey" not in tickerInfoFromMongo: return Response("You did not provide a value for lockKey", status=400)
+    if "name" not in tickerInfoFromMongo: return Response("You did not provide a value for name", status=400)
+    if "soldAt" not in tickerInfoFromMongo: return Response("You did not provide a value for soldAt", status=400)
+    if "totalInvestedSek" not in tickerInfoFromMongo: return Response("You did not provide a value for totalInvestedSek", status=400)
+
+    if tickerInfoFromMongo['boughtAt'] is not None and tickerInfoFromMongo['soldAt'] is not None:
+        return Response("At least one of soldAt or boughtAt must be null ")
+
+    expectedLockKey = copyOfTickerInfoFromMongo["lockKey"] if "lockKey" in copyOfTickerInfoFromMongo else None
+    if fileHandler.updateAsset(inputTickerName, expectedLockKey, tickerInfoFromMongo) is None:
+        return Response("lockKey does not match!", status=403)
+
+    fileHandler.writeStockChangeLog(copyOfTickerInfoFromMongo, tickerInfoFromMongo, tradedByBot)
+    stockWatcher.forceRefresh()
+    return Response(status=200)
 
 @app.route("/tradingpal/getTickerValue", methods = ['GET'])
 def getTickerValue():
@@ -250,21 +260,71 @@ def getTickerValue():
     if ticker is None or currency is None:
         return "Missing arg ticker or currency"
 
-    return json.dumps(stocksFetcher.fetchTickerInfo(ticker, currency, useCacheForDynamics=True, getStaticData=False), indent=4)
+    try:
+        tickerInfo = stocksFetcher.fetchTickerInfo(ticker, currency, useCacheForDynamics=True, getStaticData=False, interactive=True)
+    except HttpClient.RateLimitedError as ex:
+        return Response(str(ex), status=503, headers={"Retry-After": "5"})
+
+    return json.dumps(tickerInfo, indent=4)
+
+@app.route("/tradingpal/history", methods = ['GET'])
+def getHistory():
+    if priceHistory is None:
+        return Response("Price history is not enabled, set TP_HISTORY_DIR", status=404)
+
+    ticker = request.args.get("ticker")
+    if ticker is None:
+        return Response("please provide ticker", status=400)
+
+    try:
+        fromTimestamp = float(request.args.get("from", 0))
+        toTimestamp = request.args.get("to")
+        toTimestamp = None if toTimestamp is None else float(toTimestamp)
+        step = float(request.args.get("step", 0))
+    except ValueError:
+        return Response("from, to and step must be numbers (epoch seconds and seconds)", status=400)
+
+    if not all(math.isfinite(value) for value in (fromTimestamp, step) + (() if toTimestamp is None else (toTimestamp,))):
+        return Response("from, to and step must be finite numbers", status=400)
+
+    return json.dumps(priceHistory.query(ticker, fromTimestamp, toTimestamp, step))
+
+@app.route("/tradingpal/getFetcherStats", methods = ['GET'])
+def getFetcherStats():
+    return json.dumps(stocksFetcher.getStats(), indent=4)
 
 @app.route("/tradingpal/getFirstChangeLogItem", methods = ['GET'])
 def getChangeLog():
     return json.dumps(fileHandler.takeFirstChangeLogItem(), indent=4)
 
+@app.route("/tradingpal/getChangeLogItems", methods = ['GET'])
+def getChangeLogItems():
 
-def checkMadeTheSwitch(oldTradeVal, newTradeVal, currentSwitchValue):
+    try:
+        maxItems = int(request.args.get("max", 100))
+        ackSeq = request.args.get("ack")
+        ackSeq = None if ackSeq is None else int(ackSeq)
+        waitSec = float(request.args.get("wait", 0))
+    except ValueError:
+        return Response("max and ack must be integers, wait a number of seconds", status=400)
 
-    if oldTradeVal == None and newTradeVal is not None:
-        return newTradeVal
-    else:
-        return currentSwitchValue
+    if maxItems < 1:
+        return Response("max must be at least 1", status=400)
+
+    items = fileHandler.takeChangeLogItems(min(maxItems, MAX_CHANGE_LOG_ITEMS), ackSeq, waitSec)
+    cursor = items[-1]["seq"] if len(items) > 0 else ackSeq
+    return json.dumps({"items": items, "cursor": cursor}, indent=4)
+
+
+def snapshotResponse(encodedDocument, snapshot):
+
+    response = Response(encodedDocument)
+    response.set_etag(snapshot.etag)
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
 
+    init()
+    updateStream.start()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import json
+
+class Snapshot:
+    """
+    One published set of stock lists. A snapshot is never modified after it has
+    been created, readers may hold on to it and use it without any locking. The
+    documents are encoded once, up front, so serving them is only a byte copy.
+    """
+
+    def __init__(self, allStocks, stocksToBuy, stocksToSell):
+        self.allStocks = allStocks
+        self.stocksToBuy = stocksToBuy
+        self.stocksToSell = stocksToSell
+        self.updateVersion = allStocks.get("updateVersion")
+        self.stale = allStocks.get("stale", False)
+        self.etag = f"{self.updateVersion}-stale" if self.stale else f"{self.updateVersion}"
+        self.allStocksJson = json.dumps(allStocks, indent=4).encode('utf-8')
+        self.stocksToBuyJson = json.dumps(stocksToBuy, indent=4).encode('utf-8')
+        self.stocksToSellJson = json.dumps(stocksToSell, indent=4).encode('utf-8')
+        self.tickerIndex = {entry["tickerName"]: entry for entry in allStocks.get("list", [])}
+
+    def deltaSince(self, olderSnapshot):
+        """
+        Returns what changed in allStocks since olderSnapshot: the entries of tickers
+        that are new or have any changed field, the tickers that are gone and the
+        top level values (totals, counters, industries...) that changed.
+        """
+
+        changed = [entry for tickerName, entry in self.tickerIndex.items() if olderSnapshot.tickerIndex.get(tickerName) != entry]
+        removed = [tickerName for tickerName in olderSnapshot.tickerIndex if tickerName not in self.tickerIndex]
+        changedTopLevel = {key: value for key, value in self.allStocks.items()
+                           if key != "list" and olderSnapshot.allStocks.get(key) != value}
+
+        return {"delta": True,
+                "since": olderSnapshot.updateVersion,
+                "updateVersion": self.updateVersion,
+                "changed": changed,
+                "removed": removed,
+                "changedTopLevel": changedTopLevel}
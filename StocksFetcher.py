@@ -1,9 +1,16 @@
-import requests
+import os
 from lxml import html
 import json
 import copy
-from bs4 import BeautifulSoup
-import urllib3
+import re
+import random
+import concurrent.futures
+import threading
+import types
+import FetchCache
+import HttpClient
+from collections import namedtuple
+from urllib.parse import quote
 from datetime import datetime, timedelta
 
 currency_urls = {
@@ -15,47 +22,255 @@ currency_urls = {
     'DKK': 'http://www.4-traders.com/DANISH-KRONE-SWEDISH-KR-2371195/'
 }
 
+# When a currency page cannot be read, its SEK rate is derived from a yahoo quote
+# against the currency listed here, times that currency's SEK rate.
+CROSS_RATE_VIA = {
+    'USD': 'EUR',
+    'CAD': 'USD',
+    'EUR': 'USD',
+    'GBP': 'EUR',
+    'NOK': 'EUR',
+    'DKK': 'EUR'
+}
+
+CACHE_DIRECTORY = os.getenv('TP_CACHE_DIR')
+
+STATIC_VALUE_NAMES = ('trailingPE', 'priceToSalesTrailing12Months', 'trailingAnnualDividendYield', 'enterpriseValue')
+StaticTickerValues = namedtuple('StaticTickerValues', STATIC_VALUE_NAMES)
+
+class TickerNotFoundError(Exception):
+    pass
+
 class StocksFetcher:
 
     REFRESH_CURRENCY_DELAY_HOUR = 4
     REFRESH_STATIC_DATA_DELAY_HOUR = 24
+    REFRESH_PROFILE_DATA_DELAY_HOUR = 72
+    REFRESH_TTL_JITTER = 0.2
+    RETRY_FAILED_REFRESH_MIN = 15
+    MAX_BACKGROUND_REFRESHES = 2
+    PERSISTED_PRICE_MAX_AGE_HOUR = 24
+    NOT_FOUND_TTL_MIN = 10
+    MAX_CONNECTIONS_PER_HOST = 8
+    BATCH_QUOTE_CHUNK_SIZE = 50
+    CONNECT_TIMEOUT_SEC = 3.0
+    READ_TIMEOUT_SEC = 10.0
+    MAX_RETRIES = 2
+    HEDGE_AFTER_SEC = 2.0
+    # host: (requests per second, burst)
+    HOST_RATES = {
+        "query2.finance.yahoo.com": (5.0, 10),
+        "finance.yahoo.com": (1.0, 4),
+        "www.4-traders.com": (1.0, 6)
+    }
+    MAX_INTERACTIVE_WAIT_SEC = 2.0
+
+    QUOTE_SUMMARY_URL = "https://query2.finance.yahoo.com/v10/finance/quoteSummary/{0}?formatted=true&lang=en-US&region=US&modules={1}&corsDomain=finance.yahoo.com"
+    BATCH_QUOTE_URL = "https://query2.finance.yahoo.com/v7/finance/quote?lang=en-US&region=US&fields=regularMarketPrice&symbols={0}"
+    KEY_STATISTICS_URL = "https://finance.yahoo.com/quote/{0}/key-statistics?p={0}"
 
     # ################################################################################
     # Construct
     # ################################################################################
-    def __init__(self):
-        self.currencyConverter = {}
+    def __init__(self, cacheDirectory=CACHE_DIRECTORY):
+        self.currencyConverter = types.MappingProxyType({})
         self.staticTickerData = {}
+        self.profileTickerData = {}
         self.dynamicTickerData = {}
         self.lastRefreshedCurrencies = datetime.utcnow() - timedelta(days=1000)
-        self.lastRefreshedStaticData = datetime.utcnow() - timedelta(days=1000)
-        self.http = urllib3.PoolManager()
+        self.cacheLock = threading.Lock()
+        self.currencyLock = threading.Lock()
+        self.refreshingCurrencies = False
+        self.currencyRetryAt = datetime.utcnow()
+        self.refreshPool = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_BACKGROUND_REFRESHES)
+        self.refreshingEntries = set()
+        self.inFlight = {}
+        self.notFoundTickers = {}
+        self.cacheStats = {tier: {'hits': 0, 'misses': 0, 'refreshes': 0, 'refreshFailures': 0} for tier in ('static', 'profile')}
+        self.coalescingStats = {'coalesced': 0, 'notFoundHits': 0}
+        self.http = HttpClient.HttpClient(maxConnectionsPerHost=self.MAX_CONNECTIONS_PER_HOST, connectTimeoutSec=self.CONNECT_TIMEOUT_SEC,
+                                          readTimeoutSec=self.READ_TIMEOUT_SEC, maxRetries=self.MAX_RETRIES, hedgeAfterSec=self.HEDGE_AFTER_SEC,
+                                          rateLimiter=HttpClient.RateLimiter(self.HOST_RATES, maxInteractiveWaitSec=self.MAX_INTERACTIVE_WAIT_SEC))
+        self.persistentCache = None
+        if cacheDirectory is not None:
+            self.persistentCache = FetchCache.FetchCache(cacheDirectory)
+            self._loadPersistentCache()
 
     # ################################################################################
-    # Fetches info for a ticker...
+    # Warm starts the caches from the persistent fetch cache. Entries keep the time
+    # they were fetched, so the normal expiry rules apply to them.
     # ################################################################################
-    def fetchTickerInfo(self, ticker, currency, useCacheForDynamics=False, getStaticData = True):
+    def _loadPersistentCache(self):
+
+        persistedCurrencies = self.persistentCache.load('currency')
+        if 'rates' in persistedCurrencies:
+            rates, self.lastRefreshedCurrencies = persistedCurrencies['rates']
+            self.currencyConverter = types.MappingProxyType({currency: float(rate) for currency, rate in rates.items()})
+
+        for ticker, (values, fetchedAt) in self.persistentCache.load('static').items():
+            self._storeCachedEntry('static', self.staticTickerData, ticker, StaticTickerValues(*values),
+                                   self.REFRESH_STATIC_DATA_DELAY_HOUR, fetchedAt=fetchedAt, persist=False)
+
+        for ticker, (values, fetchedAt) in self.persistentCache.load('profile').items():
+            self._storeCachedEntry('profile', self.profileTickerData, ticker, values,
+                                   self.REFRESH_PROFILE_DATA_DELAY_HOUR, fetchedAt=fetchedAt, persist=False)
 
-        self._refreshCurrencyConvertions()
-        summary_data = self._fetchDynamicData(ticker, useCacheForDynamics)
+        oldestPrice = datetime.utcnow() - timedelta(hours=self.PERSISTED_PRICE_MAX_AGE_HOUR)
+        for ticker, (summary_data, fetchedAt) in self.persistentCache.load('dynamic').items():
+            if fetchedAt > oldestPrice:
+                self.dynamicTickerData[ticker] = summary_data
+
+        print(f"Loaded persistent fetch cache: {len(self.staticTickerData)} static, {len(self.profileTickerData)} profile, {len(self.dynamicTickerData)} prices")
+
+    # ################################################################################
+    # Fetches info for a ticker... Safe to call from many threads at once. The
+    # number of concurrent connections to one host is bounded by
+    # MAX_CONNECTIONS_PER_HOST, further callers block until a connection is free.
+    # Every request has a deadline and a bounded number of retries, see HttpClient.
+    # Interactive lookups give way to the refresh cycle when a host is near its
+    # rate limit and raise HttpClient.RateLimitedError instead of queueing.
+    # ################################################################################
+    def fetchTickerInfo(self, ticker, currency, useCacheForDynamics=False, getStaticData = True, interactive=False):
+
+        with self.http.priority(HttpClient.PRIORITY_INTERACTIVE if interactive else HttpClient.PRIORITY_REFRESH):
+            self._refreshCurrencyConvertions()
+            summary_data = self._fetchDynamicData(ticker, useCacheForDynamics)
+            return self._completeTickerInfo(summary_data, ticker, currency, getStaticData)
+
+    # ################################################################################
+    # Fetches info for many tickers at once. tickersAndCurrencies is a list of
+    # (ticker, currency) tuples. Prices are fetched with one multi-symbol quote
+    # request per BATCH_QUOTE_CHUNK_SIZE tickers, and only tickers the batch call
+    # could not resolve fall back to a quoteSummary request of their own. If an
+    # executor is given the requests are spread over it.
+    # Returns a dict ticker -> summary_data, or ticker -> Exception on failure.
+    # ################################################################################
+    def fetchTickerInfoBatch(self, tickersAndCurrencies, useCacheForDynamics=False, getStaticData=True, executor=None):
+
+        if len(tickersAndCurrencies) == 0:
+            return {}
+
+        try:
+            self._refreshCurrencyConvertions()
+        except Exception as ex:
+            print(f"Could not refresh currency convertion ratios ({ex})")
+
+        results = {}
+        summaries = {}
+        tickersToFetch = []
+
+        for ticker, currency in tickersAndCurrencies:
+            cachedData = None
+            if useCacheForDynamics:
+                with self.cacheLock:
+                    cachedData = copy.deepcopy(self.dynamicTickerData.get(ticker))
+            if cachedData is not None:
+                summaries[ticker] = cachedData
+            else:
+                tickersToFetch.append(ticker)
+
+        chunks = [tickersToFetch[i:i + self.BATCH_QUOTE_CHUNK_SIZE] for i in range(0, len(tickersToFetch), self.BATCH_QUOTE_CHUNK_SIZE)]
+        batchPrices = {}
+        for chunkPrices in self._runAll(executor, self._fetchBatchQuotes, chunks):
+            if isinstance(chunkPrices, Exception):
+                print(f"Batch quote request failed, falling back to single requests ({chunkPrices})")
+                continue
+            batchPrices.update(chunkPrices)
+
+        fallbackTickers = []
+        batchSummaries = {}
+        for ticker in tickersToFetch:
+            summary_data = self._summaryFromBatchPrice(ticker, batchPrices)
+            if summary_data is None:
+                fallbackTickers.append(ticker)
+            else:
+                batchSummaries[ticker] = summary_data
+        self._storeDynamicDataMany(batchSummaries)
+        summaries.update(batchSummaries)
+
+        for ticker, summary_data in zip(fallbackTickers, self._runAll(executor, self._fetchDynamicData, fallbackTickers)):
+            if isinstance(summary_data, Exception):
+                results[ticker] = summary_data
+            else:
+                summaries[ticker] = summary_data
+
+        toComplete = [(summaries[ticker], ticker, currency, getStaticData) for ticker, currency in tickersAndCurrencies if ticker in summaries]
+        for args, tickerInfo in zip(toComplete, self._runAll(executor, self._completeTickerInfo, toComplete)):
+            results[args[1]] = tickerInfo
+
+        return results
+
+    # ################################################################################
+    # Adds profile data, static data and the SEK price to freshly fetched dynamic data
+    # ################################################################################
+    def _completeTickerInfo(self, summary_data, ticker, currency, getStaticData):
+
+        self._getProfileData(summary_data, ticker)
         if getStaticData:
             self._getStaticData(summary_data, ticker)
-        summary_data['price_in_sek'] = self._convertToSek(summary_data['price'], currency.upper())
-        summary_data['convertToSekRatio'] = float(self.currencyConverter[currency.upper()])
+        currencyConverter = self.currencyConverter
+        summary_data['price_in_sek'] = self._convertToSek(summary_data['price'], currency.upper(), currencyConverter)
+        summary_data['convertToSekRatio'] = currencyConverter[currency.upper()]
 
         return summary_data
 
+    # ################################################################################
+    # Calls function once per entry in argsList, on the executor if there is one.
+    # Returns the results in argsList order, an exception in place of a result for
+    # calls that raised.
+    # ################################################################################
+    def _runAll(self, executor, function, argsList):
+
+        argsList = [args if isinstance(args, tuple) else (args,) for args in argsList]
+
+        if executor is None:
+            results = []
+            for args in argsList:
+                try:
+                    results.append(function(*args))
+                except Exception as ex:
+                    results.append(ex)
+            return results
+
+        futures = [executor.submit(function, *args) for args in argsList]
+        return [future.result() if future.exception() is None else future.exception() for future in futures]
+
     # ################################################################################
     # Refreshes the currency convertion ratios, if needed... You may call this
-    # function as often as you like.
+    # function as often as you like. Once there is a rate table the refresh runs in
+    # the background and callers keep converting with the current table, only the
+    # very first fetch (nothing cached or persisted) is done on the callers thread.
     # ################################################################################
     def _refreshCurrencyConvertions(self):
 
-        timeSinceLastRefresh = datetime.utcnow() - self.lastRefreshedCurrencies
+        with self.currencyLock:
+            if len(self.currencyConverter) == 0:
+                self._refreshCurrencyTable()
+                return
 
-        if timeSinceLastRefresh.total_seconds() > (self.REFRESH_CURRENCY_DELAY_HOUR * 60 * 60):
-            self._fetchCurrenciesFromInternet()
-            self.lastRefreshedCurrencies = datetime.utcnow()
+            timeSinceLastRefresh = datetime.utcnow() - self.lastRefreshedCurrencies
+            if timeSinceLastRefresh.total_seconds() > (self.REFRESH_CURRENCY_DELAY_HOUR * 60 * 60) and \
+                    not self.refreshingCurrencies and datetime.utcnow() >= self.currencyRetryAt:
+                self.refreshingCurrencies = True
+                self.refreshPool.submit(self._refreshCurrenciesInBackground)
+
+    def _refreshCurrenciesInBackground(self):
+
+        try:
+            self._refreshCurrencyTable()
+        except Exception as ex:
+            print(f"Background refresh of currency convertion ratios failed, keeping the old ones ({ex})")
+            self.currencyRetryAt = datetime.utcnow() + timedelta(minutes=self.RETRY_FAILED_REFRESH_MIN)
+        finally:
+            self.refreshingCurrencies = False
+
+    def _refreshCurrencyTable(self):
+
+        rates = self._fetchCurrenciesFromInternet()
+        self.currencyConverter = types.MappingProxyType(rates)
+        self.lastRefreshedCurrencies = datetime.utcnow()
+        if self.persistentCache is not None:
+            self.persistentCache.put('currency', 'rates', rates, self.lastRefreshedCurrencies)
 
     # ################################################################################
     # Gets static data, such as currency for a stock, i.e. values that are assumed
@@ -63,132 +278,354 @@ class StocksFetcher:
     # ################################################################################
     def _getStaticData(self, summary_data, ticker):
 
-        timeSinceLastRefresh = datetime.utcnow() - self.lastRefreshedStaticData
+        staticValues = self._getCachedEntry('static', self.staticTickerData, ticker,
+                                            self.REFRESH_STATIC_DATA_DELAY_HOUR, self._fetchStaticDataFromInternet)
+        summary_data.update(staticValues._asdict())
+
+    # ################################################################################
+    # Gets the company profile (industry and number of employees) for a ticker. The
+    # profile rarely changes, so it is cached for REFRESH_PROFILE_DATA_DELAY_HOUR
+    # and fetched separately from the price.
+    # ################################################################################
+    def _getProfileData(self, summary_data, ticker):
+
+        try:
+            profile = self._getCachedEntry('profile', self.profileTickerData, ticker,
+                                           self.REFRESH_PROFILE_DATA_DELAY_HOUR, self._fetchProfileDataFromInternet)
+        except Exception as ex:
+            print(f"Could not fetch profile for {ticker}. Ignoring.. ({ex})")
+            profile = {'industry': "unknown", 'employees': 0}
+
+        summary_data['industry'] = profile['industry']
+        summary_data['employees'] = profile['employees']
+
+    # ################################################################################
+    # Looks up a ticker in one of the slow changing caches. Every entry has its own,
+    # jittered, expiry so entries do not all go stale at the same moment. A stale
+    # entry is still returned right away and refreshed in the background, only a
+    # ticker that is not cached at all is fetched on the callers thread.
+    # ################################################################################
+    def _getCachedEntry(self, tier, cache, ticker, ttlHours, fetchFunction):
+
+        with self.cacheLock:
+            entry = cache.get(ticker)
+
+            if entry is not None:
+                self.cacheStats[tier]['hits'] += 1
+
+                if datetime.utcnow() >= entry['refreshAt'] and (tier, ticker) not in self.refreshingEntries:
+                    self.refreshingEntries.add((tier, ticker))
+                    self.cacheStats[tier]['refreshes'] += 1
+                    self.refreshPool.submit(self._refreshCachedEntry, tier, cache, ticker, ttlHours, fetchFunction)
+
+                return entry['values']
+
+            self.cacheStats[tier]['misses'] += 1
+
+        return self._singleFlight((tier, ticker), self._fetchAndStoreCachedEntry, tier, cache, ticker, ttlHours, fetchFunction)
+
+    def _fetchAndStoreCachedEntry(self, tier, cache, ticker, ttlHours, fetchFunction):
 
-        if timeSinceLastRefresh.total_seconds() > (self.REFRESH_STATIC_DATA_DELAY_HOUR * 60 * 60):
-            print("Refreshing all static data!")
-            self.staticTickerData = {}
-            self.lastRefreshedStaticData = datetime.utcnow()
+        values = fetchFunction(ticker)
+        self._storeCachedEntry(tier, cache, ticker, values, ttlHours)
+        return values
 
-        if ticker not in self.staticTickerData:
-            self._fetchStaticDataFromInternet(ticker)
+    # ################################################################################
+    # Runs function(*args) unless a call with the same key is already running, in
+    # which case it waits for that call and shares its result, or its exception.
+    # Every caller gets its own copy of the result. A leader that was shed by the
+    # rate limiter ran at its own, interactive, priority, so its followers do not
+    # get that error but try again at theirs.
+    # ################################################################################
+    def _singleFlight(self, key, function, *args):
+
+        while True:
+            with self.cacheLock:
+                future = self.inFlight.get(key)
+                leader = future is None
+                if leader:
+                    future = concurrent.futures.Future()
+                    self.inFlight[key] = future
+                else:
+                    self.coalescingStats['coalesced'] += 1
+
+            if leader:
+                try:
+                    future.set_result(function(*args))
+                except Exception as ex:
+                    future.set_exception(ex)
+                finally:
+                    with self.cacheLock:
+                        del self.inFlight[key]
+
+            try:
+                return copy.deepcopy(future.result())
+            except HttpClient.RateLimitedError:
+                if leader:
+                    raise
 
-        summary_data['trailingPE'] = 0
-        summary_data['priceToSalesTrailing12Months'] = 0
-        summary_data['trailingAnnualDividendYield'] = 0
-        summary_data['enterpriseValue'] = 0
+    def _refreshCachedEntry(self, tier, cache, ticker, ttlHours, fetchFunction):
 
         try:
-            soup_data = self.staticTickerData[ticker]['soup_statistics']
-            summary_data['trailingPE'] = self.extractStaticValue("trailingPE", soup_data)
-            summary_data['priceToSalesTrailing12Months'] = self.extractStaticValue("priceToSalesTrailing12Months",
-                                                                               soup_data)
-            summary_data['trailingAnnualDividendYield'] = self.extractStaticValue("trailingAnnualDividendYield", soup_data)
-            summary_data['enterpriseValue'] = self.extractStaticValue("enterpriseValue", soup_data)
-        except Exception:
-            if ticker in self.staticTickerData:
-                del(self.staticTickerData[ticker])
-            print("Could not extract additional static data from web reply. Ignoring.. " + ticker)
+            self._storeCachedEntry(tier, cache, ticker, fetchFunction(ticker), ttlHours)
+        except Exception as ex:
+            print(f"Background refresh of {tier} data failed for {ticker}, keeping the old values ({ex})")
+            with self.cacheLock:
+                self.cacheStats[tier]['refreshFailures'] += 1
+                cache[ticker]['refreshAt'] = datetime.utcnow() + timedelta(minutes=self.RETRY_FAILED_REFRESH_MIN)
+        finally:
+            with self.cacheLock:
+                self.refreshingEntries.discard((tier, ticker))
+
+    def _storeCachedEntry(self, tier, cache, ticker, values, ttlHours, fetchedAt=None, persist=True):
+
+        fetchedAt = datetime.utcnow() if fetchedAt is None else fetchedAt
+        ttl = timedelta(hours=ttlHours * random.uniform(1 - self.REFRESH_TTL_JITTER, 1))
 
+        with self.cacheLock:
+            cache[ticker] = {'values': values, 'fetchedAt': fetchedAt, 'refreshAt': fetchedAt + ttl}
+
+        if persist and self.persistentCache is not None:
+            self.persistentCache.put(tier, ticker, values, fetchedAt)
+
+    def _storeDynamicData(self, ticker, summary_data):
+        self._storeDynamicDataMany({ticker: summary_data})
+
+    def _storeDynamicDataMany(self, summaries):
+        # One persistent cache write (and commit) for all of them
+
+        with self.cacheLock:
+            for ticker, summary_data in summaries.items():
+                self.dynamicTickerData[ticker] = copy.deepcopy(summary_data)
+
+        if self.persistentCache is not None and len(summaries) > 0:
+            self.persistentCache.putMany('dynamic', summaries, datetime.utcnow())
+
+    # ################################################################################
+    # Returns counters for the caches and the http client, for monitoring
+    # ################################################################################
+    def getStats(self):
+
+        with self.cacheLock:
+            return {
+                'cache': {
+                    'static': {**self.cacheStats['static'], 'entries': len(self.staticTickerData)},
+                    'profile': {**self.cacheStats['profile'], 'entries': len(self.profileTickerData)},
+                    'dynamic': {'entries': len(self.dynamicTickerData)},
+                    'notFound': {'hits': self.coalescingStats['notFoundHits'], 'entries': len(self.notFoundTickers)},
+                    'coalesced': self.coalescingStats['coalesced'],
+                    'inFlight': len(self.inFlight),
+                    'refreshesInProgress': len(self.refreshingEntries)
+                },
+                'http': self.http.getStats()
+            }
+
+    # ################################################################################
+    # Fetches the summaryProfile module for a ticker from yahoo
+    # ################################################################################
+    def _fetchProfileDataFromInternet(self, ticker):
+
+        raw_profile_url = self.QUOTE_SUMMARY_URL.format(ticker, "summaryProfile")
+        profile_json_response = self.http.request('GET', raw_profile_url)
+
+        if profile_json_response.status != 200:
+            raise RuntimeError(f"Profile request failed with status {profile_json_response.status}")
+
+        json_loaded_profile = json.loads(profile_json_response.data)
+        profile = {'industry': "unknown", 'employees': 0}
+
+        try:
+            profile['industry'] = json_loaded_profile["quoteSummary"]["result"][0]["summaryProfile"]["industry"]
+            profile['employees'] = int(json_loaded_profile["quoteSummary"]["result"][0]["summaryProfile"]["fullTimeEmployees"])
+        except:
+            pass
+
+        return profile
 
     # ################################################################################
-    # Fetches constantly updating data for a ticker. This data is not cached, and
-    # always refreshed from yahoo
+    # Fetches constantly updating data for a ticker. Only the price module is asked
+    # for, the profile is fetched separately by _getProfileData. This data is not
+    # cached, and always refreshed from yahoo. Concurrent fetches of one ticker
+    # share a single request, and a ticker yahoo does not know is not asked for
+    # again until NOT_FOUND_TTL_MIN has passed.
     # ################################################################################
     def _fetchDynamicData(self, ticker, useCache=False):
 
-        summary_data = {}
+        with self.cacheLock:
+            if useCache and ticker in self.dynamicTickerData:
+                return copy.deepcopy(self.dynamicTickerData[ticker])
+
+            notFoundUntil = self.notFoundTickers.get(ticker)
+            if notFoundUntil is not None:
+                if datetime.utcnow() < notFoundUntil:
+                    self.coalescingStats['notFoundHits'] += 1
+                    raise TickerNotFoundError(f"Ticker not found: {ticker}")
+                del self.notFoundTickers[ticker]
+
+        return self._singleFlight(('dynamic', ticker), self._fetchDynamicDataFromInternet, ticker)
 
-        if useCache and ticker in self.dynamicTickerData:
-            return copy.deepcopy(self.dynamicTickerData[ticker])
+    def _fetchDynamicDataFromInternet(self, ticker):
 
-        raw_ticker_data_url = "https://query2.finance.yahoo.com/v10/finance/quoteSummary/{0}?formatted=true&lang=en-US&region=US&modules=summaryProfile%2CfinancialData%2CrecommendationTrend%2CupgradeDowngradeHistory%2Cearnings%2CdefaultKeyStatistics%2CcalendarEvents&corsDomain=finance.yahoo.com".format(ticker)
-        summary_json_response = self.http.request('GET', raw_ticker_data_url)
+        summary_data = {}
+
+        raw_ticker_data_url = self.QUOTE_SUMMARY_URL.format(ticker, "financialData")
+        summary_json_response = self.http.request('GET', raw_ticker_data_url, hedge=True)
         json_loaded_summary = json.loads(summary_json_response.data)
 
         if json_loaded_summary["quoteSummary"]["error"] is not None:
-            raise Exception(f"Ticker not found: {ticker}")
+            with self.cacheLock:
+                self.notFoundTickers[ticker] = datetime.utcnow() + timedelta(minutes=self.NOT_FOUND_TTL_MIN)
+            raise TickerNotFoundError(f"Ticker not found: {ticker}")
 
         try:
             summary_data['price'] = json_loaded_summary["quoteSummary"]["result"][0]["financialData"]["currentPrice"]['raw']
         except:
             raise Exception(f"Could not get currentPrice for {ticker}")
 
-        try:
-            summary_data['industry'] = json_loaded_summary["quoteSummary"]["result"][0]["summaryProfile"]["industry"]
-            summary_data['employees'] = int(
-                json_loaded_summary["quoteSummary"]["result"][0]["summaryProfile"]["fullTimeEmployees"])
-        except:
-            summary_data['industry'] = "unknown"
-            summary_data['employees'] = 0
-
-        self.dynamicTickerData[ticker] = copy.deepcopy(summary_data)
+        self._storeDynamicData(ticker, summary_data)
         return summary_data
 
     # ################################################################################
-    # collects static data for a ticker, such as currency. This data will be cached.
+    # Fetches the current price for a list of tickers with one multi-symbol quote
+    # request. Returns a dict ticker -> price for the tickers yahoo resolved.
+    # ################################################################################
+    def _fetchBatchQuotes(self, tickers):
+
+        batch_quote_url = self.BATCH_QUOTE_URL.format(quote(",".join(tickers), safe=","))
+        quote_json_response = self.http.request('GET', batch_quote_url, hedge=True)
+
+        if quote_json_response.status != 200:
+            raise RuntimeError(f"Batch quote request failed with status {quote_json_response.status}")
+
+        json_loaded_quotes = json.loads(quote_json_response.data)
+        prices = {}
+
+        for nextQuote in json_loaded_quotes["quoteResponse"]["result"] or []:
+            if nextQuote.get("regularMarketPrice") is not None and nextQuote.get("symbol") in tickers:
+                prices[nextQuote["symbol"]] = nextQuote["regularMarketPrice"]
+
+        return prices
+
+    # ################################################################################
+    # Builds dynamic data from a batch quote price. Returns None if the ticker has
+    # to fall back to a quoteSummary request.
+    # ################################################################################
+    def _summaryFromBatchPrice(self, ticker, batchPrices):
+
+        if ticker not in batchPrices:
+            return None
+
+        return {'price': batchPrices[ticker]}
+
+    # ################################################################################
+    # collects static data for a ticker, such as currency. The caller caches it.
     # ################################################################################
     def _fetchStaticDataFromInternet(self, ticker):
 
         print(f"Fetching static data for ticker {ticker}")
-        url_statistics = f"https://finance.yahoo.com/quote/{ticker}/key-statistics?p={ticker}".lower()
+        url_statistics = self.KEY_STATISTICS_URL.format(ticker).lower()
         try:
             html_statistics = self.http.request('GET', url_statistics)
 
             if html_statistics.status != 200:
                 raise RuntimeError(f"FAILED to get key-statistics for ticker: {ticker}, {url_statistics}")
 
-            soup_statistics = BeautifulSoup(html_statistics.data, 'lxml')
-            self.staticTickerData[ticker] = {}
-            self.staticTickerData[ticker]['soup_statistics'] = soup_statistics
+            return self.extractStaticValues(html_statistics.data.decode('utf-8', errors='replace'))
 
         except Exception:
             raise RuntimeError(f"FAILED to parse currency from message: {ticker}, {url_statistics}")
 
     # ################################################################################
-    # ...
+    # Pulls all STATIC_VALUE_NAMES out of a key-statistics page in one pass over the
+    # page text. Only the small record is kept, the page itself can be dropped.
     # ################################################################################
-    def extractStaticValue(self, valueToExtract, soup_statistics):
+    def extractStaticValues(self, pageText):
 
-        cutStringAsList = str(soup_statistics).split(valueToExtract)
+        return StaticTickerValues(*[self.extractStaticValue(valueName, pageText) for valueName in STATIC_VALUE_NAMES])
+
+    # ################################################################################
+    # Finds the first '{...}' json object following valueToExtract in the page text,
+    # i.e. '"trailingPE":{"raw":12.3,"fmt":"12.30"}', and returns its raw value.
+    # ################################################################################
+    def extractStaticValue(self, valueToExtract, pageText):
 
-        for nextSlice in cutStringAsList:
+        for match in re.finditer(re.escape(valueToExtract) + r'[^{]*(\{[^{}]*\})', pageText):
             try:
-                startOfString = nextSlice.split('{')[1]
-                startOfString = startOfString.split('}')[0]
-                valueAsJson = json.loads("{" + startOfString + "}")
-                return valueAsJson["raw"]
+                return json.loads(match.group(1))["raw"]
             except:
                 pass
 
         return None
 
     # ################################################################################
-    # Returns Conversion dictrionary from currencies to SEK
+    # Returns Conversion dictrionary from currencies to SEK, as floats. All pages are
+    # fetched in parallel. A currency whose page fails is derived from a cross rate,
+    # see CROSS_RATE_VIA, and if that fails too the previous rate is kept.
     # ################################################################################
     def _fetchCurrenciesFromInternet(self):
 
         print("Fetching currency convertion ratios...")
 
-        result = {}
-        for currency, url in currency_urls.items():
-            page = requests.get(url)
-            tree = html.fromstring(page.content)
-            cur = str(tree.xpath('//td[@class="fvPrice colorBlack"]/text()'))
-            cur_cut = cur[+2:-2]
-            result[currency] = cur_cut
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(currency_urls)) as pool:
+            pageRates = self._runAll(pool, self._fetchCurrencyPage, list(currency_urls.values()))
+
+        result = {'SEK': 1.0}
+        for currency, rate in zip(currency_urls.keys(), pageRates):
+            if isinstance(rate, Exception):
+                print(f"Could not read currency page for {currency} ({rate})")
+            else:
+                result[currency] = rate
+
+        missing = [currency for currency in currency_urls if currency not in result]
+        if len(missing) > 0:
+            result.update(self._fetchCrossRates(missing, result))
+
+        for currency in currency_urls:
+            if currency not in result and currency in self.currencyConverter:
+                print(f"Keeping previous convertion ratio for {currency}")
+                result[currency] = self.currencyConverter[currency]
+
+        if len(result) == 1:
+            raise RuntimeError("Could not get any currency convertion ratios")
+
+        return result
+
+    def _fetchCurrencyPage(self, url):
+
+        page = self.http.request('GET', url)
+        if page.status != 200:
+            raise RuntimeError(f"Currency request {url} failed with status {page.status}")
+
+        tree = html.fromstring(page.data)
+        return float(tree.xpath('//td[@class="fvPrice colorBlack"]/text()')[0].strip().replace(',', ''))
+
+    # ################################################################################
+    # Derives SEK rates for the missing currencies from yahoo quotes against the
+    # currency in CROSS_RATE_VIA, i.e. NOK = NOKEUR=X * EUR.
+    # ################################################################################
+    def _fetchCrossRates(self, missing, knownRates):
+
+        pairs = {f"{currency}{CROSS_RATE_VIA[currency]}=X": currency for currency in missing
+                 if CROSS_RATE_VIA.get(currency) in knownRates}
+        if len(pairs) == 0:
+            return {}
+
+        try:
+            quotes = self._fetchBatchQuotes(list(pairs.keys()))
+        except Exception as ex:
+            print(f"Could not fetch cross rates ({ex})")
+            return {}
 
-        result['SEK'] = "1.0"
-        self.currencyConverter = result
+        return {currency: quotes[pair] * knownRates[CROSS_RATE_VIA[currency]]
+                for pair, currency in pairs.items() if pair in quotes}
 
     # ################################################################################
     # Adds the value of the stock in SEK to the tickerSummary structure
     # ################################################################################
-    def _convertToSek(self, price, currency):
+    def _convertToSek(self, price, currency, currencyConverter):
 
         try:
-            return price * \
-                float(self.currencyConverter[currency])
+            return price * currencyConverter[currency]
         except Exception:
             print(f"Could not convert stock currency to SEK: {price} / {currency}")
             raise
@@ -0,0 +1,156 @@
+import math
+import asyncio
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+STREAM_PORT = 5001
+
+class UpdateStream:
+    """
+    Pushes published snapshots to clients, either as Server-Sent Events on
+    /tradingpal/stream or as a long-poll on /tradingpal/waitForUpdate?since=<updateVersion>.
+    Both take topic=all|buy|sell. All connections are served by one asyncio event loop
+    on its own thread, so an idle subscriber costs a socket and not an OS thread.
+    """
+
+    KEEPALIVE_SEC = 15
+    MAX_LONG_POLL_SEC = 120
+    DOCUMENTS = {"all": "allStocksJson", "buy": "stocksToBuyJson", "sell": "stocksToSellJson"}
+
+    def __init__(self, stockWatcher, host='0.0.0.0', port=STREAM_PORT):
+        self.stockWatcher = stockWatcher
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.nextSnapshot = self.loop.create_future()
+        self.encodedEvents = {}
+        self.subscribers = 0
+        stockWatcher.addPublishListener(self._onPublish)
+
+    def start(self):
+        threading.Thread(target=self._run, name="UpdateStream", daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_server(self._handleConnection, self.host, self.port))
+        print(f"Update stream listening on port {self.port}")
+        self.loop.run_forever()
+
+    def _onPublish(self, snapshot):
+        self.loop.call_soon_threadsafe(self._wakeSubscribers, snapshot)
+
+    def _wakeSubscribers(self, snapshot):
+        waitingFuture, self.nextSnapshot = self.nextSnapshot, self.loop.create_future()
+        self.encodedEvents = {}
+        waitingFuture.set_result(snapshot)
+
+    async def _waitForNextSnapshot(self, future, timeout):
+        # future is self.nextSnapshot as it was before the caller read the snapshot,
+        # so a publish while the caller was writing is not missed
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _encodeEvent(self, snapshot, topic):
+
+        key = (snapshot.etag, topic)
+        if key not in self.encodedEvents:
+            document = getattr(snapshot, self.DOCUMENTS[topic])
+            self.encodedEvents[key] = b"id: " + snapshot.etag.encode('utf-8') + b"\nevent: update\ndata: " + \
+                                      document.replace(b"\n", b"\ndata: ") + b"\n\n"
+
+        return self.encodedEvents[key]
+
+    async def _handleConnection(self, reader, writer):
+
+        try:
+            requestLine = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            method, target, _ = requestLine.decode('latin-1').split(" ", 2)
+            url = urlsplit(target)
+            args = {key: values[0] for key, values in parse_qs(url.query).items()}
+            topic = args.get("topic", "all")
+
+            if method != "GET":
+                await self._writeResponse(writer, "405 Method Not Allowed", b"GET only")
+            elif topic not in self.DOCUMENTS:
+                await self._writeResponse(writer, "400 Bad Request", b"topic must be one of all, buy, sell")
+            elif url.path == "/tradingpal/stream":
+                await self._serveEvents(writer, topic, headers.get("last-event-id"))
+            elif url.path == "/tradingpal/waitForUpdate":
+                await self._serveLongPoll(writer, topic, args.get("since"), args.get("timeout", "60"))
+            else:
+                await self._writeResponse(writer, "404 Not Found", b"Not found")
+
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serveEvents(self, writer, topic, lastEventId):
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\nConnection: keep-alive\r\n\r\n")
+        self.subscribers += 1
+
+        try:
+            while not writer.transport.is_closing():
+                future = self.nextSnapshot
+                snapshot = self.stockWatcher.getSnapshot()
+                if snapshot.etag != lastEventId:
+                    writer.write(self._encodeEvent(snapshot, topic))
+                    lastEventId = snapshot.etag
+
+                await writer.drain()
+
+                if not await self._waitForNextSnapshot(future, self.KEEPALIVE_SEC):
+                    writer.write(b": keepalive\n\n")
+        finally:
+            self.subscribers -= 1
+
+    async def _serveLongPoll(self, writer, topic, since, timeout):
+
+        if since is None:
+            await self._writeResponse(writer, "400 Bad Request", b"please provide since=<updateVersion>")
+            return
+
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = math.nan
+        if not math.isfinite(timeout) or timeout < 0:
+            await self._writeResponse(writer, "400 Bad Request", b"timeout must be a number of seconds")
+            return
+
+        timeout = min(timeout, self.MAX_LONG_POLL_SEC)
+        future = self.nextSnapshot
+        snapshot = self.stockWatcher.getSnapshot()
+
+        if str(snapshot.updateVersion) == since:
+            self.subscribers += 1
+            try:
+                if not await self._waitForNextSnapshot(future, timeout):
+                    await self._writeResponse(writer, "304 Not Modified", b"")
+                    return
+            finally:
+                self.subscribers -= 1
+            snapshot = self.stockWatcher.getSnapshot()
+
+        await self._writeResponse(writer, "200 OK", getattr(snapshot, self.DOCUMENTS[topic]), etag=snapshot.etag)
+
+    async def _writeResponse(self, writer, status, body, etag=None):
+
+        headers = f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\nAccess-Control-Allow-Origin: *\r\nConnection: close\r\n"
+        if etag is not None:
+            headers += f"ETag: \"{etag}\"\r\n"
+        writer.write(headers.encode('latin-1') + b"\r\n" + body)
+        await writer.drain()
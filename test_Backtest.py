@@ -0,0 +1,40 @@
+import numpy as np
+import Analyze
+import Backtest
+
+#
+# Backtest sweeps on a small synthetic price series. The variants replace
+# Analyze.evaluatePortfolio, Analyze.py itself never trades.
+#
+
+def makeSeries(tickerCount=5, steps=200, seed=1):
+
+    random = np.random.default_rng(seed)
+    series = {}
+    for i in range(tickerCount):
+        timestamps = np.sort(random.choice(np.arange(10 * steps), steps, replace=False)).astype(np.float64)
+        prices = np.cumprod(random.uniform(0.98, 1.02, steps)) * random.uniform(10, 500)
+        series[f"TICK{i}.ST"] = (timestamps, prices, prices * 10.0)
+    return series
+
+def buyOneOfEach(tickerNames, totalStockValues, *args):
+    tickerCount = len(tickerNames)
+    return np.ones(tickerCount, dtype=np.int64), np.zeros(tickerCount, dtype=np.int64), np.zeros(tickerCount)
+
+def withoutRuntime(reports):
+    return [{key: value for key, value in report.items() if key != "runtimeSec"} for report in reports]
+
+def test_sweep_does_not_depend_on_processes():
+    series = makeSeries()
+    variants = [{"evaluatePortfolio": buyOneOfEach}, {}, {"evaluatePortfolio": buyOneOfEach}, {}]
+
+    reports = withoutRuntime(Backtest.runSweep(series, variants, processes=1))
+    assert reports == withoutRuntime(Backtest.runSweep(series, variants, processes=3))
+    assert [report["trades"] > 0 for report in reports] == [True, False, True, False]
+
+def test_variant_overrides_are_undone():
+    tickers, timestamps, prices, pricesSek = Backtest.alignSeries(makeSeries())
+    evaluatePortfolio = Analyze.evaluatePortfolio
+
+    Backtest.runVariant(tickers, timestamps, prices, pricesSek, variant={"evaluatePortfolio": buyOneOfEach})
+    assert Analyze.evaluatePortfolio is evaluatePortfolio
@@ -0,0 +1,154 @@
+import os
+import time
+import datetime
+import threading
+import pytest
+import FileHandler
+
+#
+# The asset cache against mongomock, which has no change streams so the polling
+# fallback is used, and against a local mongod if TP_TEST_MONGO_URL is set, i.e.
+# >> TP_TEST_MONGO_URL=mongodb://localhost:27017 python3 -m pytest test_FileHandler.py
+# A replica set member there runs the change stream path.
+#
+
+TEST_DATABASE_NAME = "TPTest"
+
+def makeClient(backend):
+
+    if backend == "mongomock":
+        mongomock = pytest.importorskip("mongomock")
+        return mongomock.MongoClient()
+
+    mongoUrl = os.getenv("TP_TEST_MONGO_URL")
+    if mongoUrl is None:
+        pytest.skip("TP_TEST_MONGO_URL is not set")
+
+    import pymongo
+    return pymongo.MongoClient(mongoUrl, serverSelectionTimeoutMS=2000)
+
+def waitFor(condition, timeoutSec=5):
+
+    deadline = time.time() + timeoutSec
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+@pytest.fixture(params=["mongomock", "mongod"])
+def assets(request, monkeypatch):
+
+    monkeypatch.setattr(FileHandler, "databaseName", TEST_DATABASE_NAME)
+    monkeypatch.setattr(FileHandler, "ASSET_POLL_INTERVAL_SEC", 0.05)
+    monkeypatch.setattr(FileHandler, "ASSET_FULL_RESYNC_SEC", 1)
+
+    client = makeClient(request.param)
+    collection = client[TEST_DATABASE_NAME][FileHandler.collectionNameStockAssets]
+    collection.drop()
+    client[TEST_DATABASE_NAME][FileHandler.collectionNameChangeLog].drop()
+    collection.insert_many([{"ticker": "AAA.ST", "name": "A", "count": 1, "lockKey": 0},
+                            {"ticker": "BBB.ST", "name": "B", "count": 2, "lockKey": 0}])
+
+    fileHandler = FileHandler.FileHandler()
+    fileHandler.init(mongoClient=client)
+    yield fileHandler, collection
+    collection.drop()
+
+def test_cache_is_loaded_at_init(assets):
+    fileHandler, _ = assets
+    assert fileHandler.readAssetsFromMongo() == {"AAA.ST": {"name": "A", "count": 1, "lockKey": 0},
+                                                 "BBB.ST": {"name": "B", "count": 2, "lockKey": 0}}
+
+def test_cache_follows_external_insert(assets):
+    fileHandler, collection = assets
+    collection.insert_one({"ticker": "CCC.ST", "name": "C", "count": 3, "lockKey": 0})
+    assert waitFor(lambda: fileHandler.readAsset("CCC.ST") == {"name": "C", "count": 3, "lockKey": 0})
+
+def test_cache_follows_external_update(assets):
+    fileHandler, collection = assets
+    collection.update_one({"ticker": "AAA.ST"}, {"$set": {"count": 10, "lastModified": datetime.datetime.utcnow()}})
+    assert waitFor(lambda: fileHandler.readAsset("AAA.ST")["count"] == 10)
+
+def test_cache_follows_external_update_without_lastModified(assets):
+    # Only picked up by the full reload when polling
+    fileHandler, collection = assets
+    collection.update_one({"ticker": "BBB.ST"}, {"$set": {"count": 20}})
+    assert waitFor(lambda: fileHandler.readAsset("BBB.ST")["count"] == 20)
+
+def test_cache_follows_external_delete(assets):
+    fileHandler, collection = assets
+    collection.delete_one({"ticker": "BBB.ST"})
+    assert waitFor(lambda: fileHandler.readAsset("BBB.ST") is None)
+    assert fileHandler.readAsset("AAA.ST") is not None
+
+def test_changelog_items_from_another_replica(assets, monkeypatch):
+    fileHandler, collection = assets
+    monkeypatch.setattr(FileHandler, "PRODUCTION", "true")
+    otherReplica = FileHandler.FileHandler()
+    otherReplica.init(mongoClient=collection.database.client)
+
+    stock = {"name": "A", "count": 1, "lockKey": 0, "lockCounter": 0, "totalInvestedSek": 100}
+    otherReplica.writeStockChangeLog(stock, {**stock, "count": 2, "totalInvestedSek": 200}, tradedByBot=True)
+    fileHandler.writeStockChangeLog(stock, {**stock, "count": 3, "totalInvestedSek": 300}, tradedByBot=True)
+
+    items = fileHandler.takeChangeLogItems(10)
+    assert [item["count"] for item in items] == [2, 3]
+    assert fileHandler.takeChangeLogItems(10, ackSeq=items[-1]["seq"]) == []
+    assert otherReplica.takeChangeLogItems(10) == []
+
+def test_changelog_long_poll_sees_another_replica(assets, monkeypatch):
+    fileHandler, collection = assets
+    monkeypatch.setattr(FileHandler, "PRODUCTION", "true")
+    monkeypatch.setattr(FileHandler, "CHANGE_LOG_POLL_SEC", 0.05)
+    otherReplica = FileHandler.FileHandler()
+    otherReplica.init(mongoClient=collection.database.client)
+
+    stock = {"name": "A", "count": 1, "lockKey": 0, "lockCounter": 0, "totalInvestedSek": 100}
+    writer = threading.Timer(0.2, otherReplica.writeStockChangeLog, (stock, {**stock, "count": 2}, False))
+    writer.start()
+    items = fileHandler.takeChangeLogItems(10, waitSec=5)
+    writer.join()
+    assert [item["count"] for item in items] == [2]
+
+def test_changelog_delayed_insert_of_a_lower_seq(assets, monkeypatch):
+    # A writer takes its seq and inserts later, after higher seqs were delivered
+    fileHandler, collection = assets
+    monkeypatch.setattr(FileHandler, "PRODUCTION", "true")
+    delayedSeqs = [fileHandler._nextChangeLogSeq(), fileHandler._nextChangeLogSeq()]
+
+    stock = {"name": "A", "count": 1, "lockKey": 0, "lockCounter": 0, "totalInvestedSek": 100}
+    fileHandler.writeStockChangeLog(stock, {**stock, "count": 3}, tradedByBot=False)
+    items = fileHandler.takeChangeLogItems(10)
+    assert [item["count"] for item in items] == [3]
+
+    def writeDelayed(seq, count):
+        monkeypatch.setattr(fileHandler, "_nextChangeLogSeq", lambda: seq)
+        fileHandler.writeStockChangeLog(stock, {**stock, "count": count}, tradedByBot=False)
+
+    # Inserted between the delivery of seq 3 and its ack
+    writeDelayed(delayedSeqs[0], 1)
+    items = fileHandler.takeChangeLogItems(10, ackSeq=items[-1]["seq"])
+    assert [item["count"] for item in items] == [1]
+
+    # Inserted after everything above it was delivered and acked
+    assert fileHandler.takeChangeLogItems(10, ackSeq=items[-1]["seq"]) == []
+    writeDelayed(delayedSeqs[1], 2)
+    assert [item["count"] for item in fileHandler.takeChangeLogItems(10)] == [2]
+
+def test_changelog_acked_by_another_replica(assets, monkeypatch):
+    fileHandler, collection = assets
+    monkeypatch.setattr(FileHandler, "PRODUCTION", "true")
+    otherReplica = FileHandler.FileHandler()
+    otherReplica.init(mongoClient=collection.database.client)
+
+    stock = {"name": "A", "count": 1, "lockKey": 0, "lockCounter": 0, "totalInvestedSek": 100}
+    otherReplica.writeStockChangeLog(stock, {**stock, "count": 1}, tradedByBot=False)
+    items = otherReplica.takeChangeLogItems(10)
+    assert otherReplica.takeChangeLogItems(10, ackSeq=items[-1]["seq"]) == []
+
+    otherReplica.writeStockChangeLog(stock, {**stock, "count": 2}, tradedByBot=False)
+    items = fileHandler.takeChangeLogItems(10)
+    assert [item["count"] for item in items] == [2]
+    assert fileHandler.takeChangeLogItems(10, ackSeq=items[-1]["seq"]) == []
+    assert otherReplica.takeChangeLogItems(10) == []
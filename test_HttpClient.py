@@ -0,0 +1,170 @@
+import time
+import threading
+import http.server
+import pytest
+import urllib3
+import HttpClient
+
+#
+# HttpClient against a local fake upstream. Every path plays a script of
+# (delaySec, status) steps, one per call, and repeats the last step when the
+# script runs out. Every test gets its own server and client.
+#
+
+class FakeUpstream(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            calls = server.calls.get(self.path, 0)
+            server.calls[self.path] = calls + 1
+            script = server.scripts[self.path]
+            delaySec, status = script[min(calls, len(script) - 1)]
+
+        time.sleep(delaySec)
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def upstream():
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstream)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = {}
+    server.scripts = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def serve(path, *script):
+        server.scripts[path] = script
+        return f"http://127.0.0.1:{server.server_port}{path}"
+
+    serve.server = server
+    yield serve
+    server.shutdown()
+
+def makeClient(**kwargs):
+    options = {"connectTimeoutSec": 1.0, "readTimeoutSec": 1.0, "maxRetries": 2, "backoffSec": 0.01, "hedgeAfterSec": None,
+               "rateLimiter": HttpClient.RateLimiter(defaultRate=(1000.0, 1000))}
+    options.update(kwargs)
+    return HttpClient.HttpClient(**options)
+
+def test_read_deadline(upstream):
+    url = upstream("/hang", (5, 200))
+    client = makeClient(readTimeoutSec=0.2, maxRetries=1)
+
+    startTime = time.perf_counter()
+    with pytest.raises(urllib3.exceptions.ReadTimeoutError):
+        client.request('GET', url)
+
+    assert time.perf_counter() - startTime < 1.5
+    assert upstream.server.calls["/hang"] == 2
+    assert client.getStats()["failures"] == 1
+
+def test_retries_until_success(upstream):
+    url = upstream("/flaky", (0, 500), (0, 502), (0, 200))
+    client = makeClient(maxRetries=2)
+
+    assert client.request('GET', url).status == 200
+    assert upstream.server.calls["/flaky"] == 3
+    assert client.getStats()["retries"] == 2
+    assert client.getStats()["failures"] == 0
+
+def test_retries_are_bounded(upstream):
+    url = upstream("/fail", (0, 500))
+    client = makeClient(maxRetries=2)
+
+    assert client.request('GET', url).status == 500
+    assert upstream.server.calls["/fail"] == 3
+    assert client.getStats()["failures"] == 1
+
+def test_breaker_opens_and_fails_fast(upstream):
+    url = upstream("/fail", (0, 500))
+    client = makeClient(maxRetries=0)
+
+    for _ in range(client.BREAKER_FAILURE_THRESHOLD):
+        assert client.request('GET', url).status == 500
+
+    startTime = time.perf_counter()
+    with pytest.raises(HttpClient.CircuitOpenError):
+        client.request('GET', url)
+
+    assert time.perf_counter() - startTime < 0.1
+    assert upstream.server.calls["/fail"] == client.BREAKER_FAILURE_THRESHOLD
+    assert client.getStats()["openCircuits"] == [f"127.0.0.1:{upstream.server.server_port}"]
+
+def test_breaker_half_open_trial_fails(upstream):
+    url = upstream("/fail", (0, 500))
+    client = makeClient(maxRetries=0)
+    client.BREAKER_OPEN_SEC = 0.2
+
+    for _ in range(client.BREAKER_FAILURE_THRESHOLD):
+        client.request('GET', url)
+    time.sleep(0.3)
+
+    # One trial goes through, and its failure opens the circuit again right away
+    assert client.request('GET', url).status == 500
+    with pytest.raises(HttpClient.CircuitOpenError):
+        client.request('GET', url)
+    assert upstream.server.calls["/fail"] == client.BREAKER_FAILURE_THRESHOLD + 1
+
+def test_breaker_half_open_trial_succeeds(upstream):
+    url = upstream("/recovers", *([(0, 500)] * HttpClient.HttpClient.BREAKER_FAILURE_THRESHOLD), (0, 200))
+    client = makeClient(maxRetries=0)
+    client.BREAKER_OPEN_SEC = 0.2
+
+    for _ in range(client.BREAKER_FAILURE_THRESHOLD):
+        client.request('GET', url)
+    with pytest.raises(HttpClient.CircuitOpenError):
+        client.request('GET', url)
+    time.sleep(0.3)
+
+    assert client.request('GET', url).status == 200
+    assert client.request('GET', url).status == 200
+    assert client.getStats()["openCircuits"] == []
+
+def test_hedge_wins_over_slow_primary(upstream):
+    url = upstream("/slow", (2, 200), (0, 200))
+    client = makeClient(hedgeAfterSec=0.05)
+
+    startTime = time.perf_counter()
+    assert client.request('GET', url, hedge=True).status == 200
+
+    assert time.perf_counter() - startTime < 1
+    assert upstream.server.calls["/slow"] == 2
+    assert client.getStats()["hedges"] == 1
+    assert client.getStats()["hedgeWins"] == 1
+
+def test_no_hedge_for_fast_primary(upstream):
+    url = upstream("/fast", (0, 200))
+    client = makeClient(hedgeAfterSec=0.5)
+
+    assert client.request('GET', url, hedge=True).status == 200
+    assert upstream.server.calls["/fast"] == 1
+    assert client.getStats()["hedges"] == 0
+
+def test_no_hedge_while_queued_locally(upstream):
+    url = upstream("/fast", (0, 200))
+    client = makeClient(maxConnectionsPerHost=1, hedgeAfterSec=0.05)
+    for _ in range(2):
+        client.hedgePool.submit(time.sleep, 0.3)
+
+    assert client.request('GET', url, hedge=True).status == 200
+    assert upstream.server.calls["/fast"] == 1
+    assert client.getStats()["hedges"] == 0
+
+@pytest.mark.parametrize("status", HttpClient.THROTTLE_STATUSES)
+def test_throttling_does_not_open_breaker(upstream, status):
+    url = upstream("/throttle", (0, status))
+    client = makeClient(maxRetries=0)
+
+    for _ in range(2 * client.BREAKER_FAILURE_THRESHOLD):
+        assert client.request('GET', url).status == status
+
+    assert client.getStats()["openCircuits"] == []
+    assert client.getStats()["rateLimiter"]["throttled"] == 2 * client.BREAKER_FAILURE_THRESHOLD
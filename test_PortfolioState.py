@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import Analyze
+import PortfolioState
+from PortfolioState import TransactionMode
+
+#
+# Analyze.evaluatePortfolio against the scalar functions of Analyze.py, which
+# are the reference. Run it again whenever you change the strategy.
+#
+
+def randomPortfolio(tickerCount=1000, seed=1):
+    # The arguments of evaluatePortfolio as MainStockWatcher builds them, with None as NaN
+
+    random = np.random.default_rng(seed)
+    tickerNames = [f"TICK{i}" for i in range(tickerCount)]
+    pricesOrigCurr = random.uniform(1, 1000, tickerCount)
+    pricesSek = pricesOrigCurr * random.choice([1.0, 8.5, 10.2, 11.9], tickerCount)
+    totalStockValues = np.floor(pricesSek * random.integers(1, 500, tickerCount))
+    boughtAt = np.where(random.random(tickerCount) < 0.5, pricesOrigCurr * random.uniform(0.5, 1.5, tickerCount), 0)
+    soldAt = np.where(boughtAt == 0, pricesOrigCurr * random.uniform(0.5, 1.5, tickerCount), 10000000)
+    switchedAt = np.maximum(boughtAt, np.where(soldAt < 10000000, soldAt, 0))
+    transactionModes = random.choice([mode.value for mode in TransactionMode], tickerCount)
+    investedTot = np.floor(totalStockValues * random.uniform(0.5, 1.5, tickerCount))
+
+    # A ticker that was never traded, and one with switchedAt stored as None
+    boughtAt[0], switchedAt[0] = np.nan, np.nan
+    switchedAt[1] = np.nan
+
+    return tickerNames, totalStockValues, pricesSek, pricesOrigCurr, boughtAt, soldAt, switchedAt, transactionModes, investedTot
+
+def scalarValue(value):
+    return None if np.isnan(value) else value
+
+def assertMatchesScalar(portfolio, result):
+
+    tickerNames, totalStockValues, pricesSek, pricesOrigCurr, boughtAt, soldAt, switchedAt, transactionModes, investedTot = portfolio
+    numberToBuy, numberToSell, buyIndication = result
+    assert len(numberToBuy) == len(numberToSell) == len(buyIndication) == len(tickerNames)
+
+    for i, tickerName in enumerate(tickerNames):
+        scalarArgs = (tickerName, totalStockValues[i], pricesSek[i], pricesOrigCurr[i], scalarValue(boughtAt[i]),
+                      scalarValue(soldAt[i]), scalarValue(switchedAt[i]), TransactionMode(transactionModes[i]))
+        assert numberToBuy[i] == Analyze.howManyToBuy(*scalarArgs), f"howManyToBuy differs for {tickerName}"
+        assert numberToSell[i] == Analyze.howManyToSell(*scalarArgs), f"howManyToSell differs for {tickerName}"
+        assert np.isclose(buyIndication[i], Analyze.getBuyIndication(totalStockValues[i], investedTot[i])), f"getBuyIndication differs for {tickerName}"
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_batch_matches_scalar(seed):
+    portfolio = randomPortfolio(seed=seed)
+    assertMatchesScalar(portfolio, PortfolioState.evaluatePortfolio(*portfolio))
+
+def test_fallback_without_evaluatePortfolio(monkeypatch):
+    monkeypatch.delattr(Analyze, "evaluatePortfolio")
+    portfolio = randomPortfolio(tickerCount=50)
+    assertMatchesScalar(portfolio, PortfolioState.evaluatePortfolio(*portfolio))
+
+def test_fallback_passes_None_for_NaN(monkeypatch):
+    monkeypatch.delattr(Analyze, "evaluatePortfolio")
+    calls = []
+    monkeypatch.setattr(Analyze, "howManyToBuy", lambda *args: calls.append(args) or 1)
+    monkeypatch.setattr(Analyze, "howManyToSell", lambda *args: 2)
+    monkeypatch.setattr(Analyze, "getBuyIndication", lambda stockValueTot, investedTot: 0.5)
+
+    portfolio = randomPortfolio(tickerCount=2)
+    numberToBuy, numberToSell, buyIndication = PortfolioState.evaluatePortfolio(*portfolio)
+
+    assert list(numberToBuy) == [1, 1] and list(numberToSell) == [2, 2] and list(buyIndication) == [0.5, 0.5]
+    assert [call[0] for call in calls] == ["TICK0", "TICK1"]
+    assert calls[0][4] is None and calls[0][6] is None and calls[1][6] is None
+    assert all(isinstance(call[7], Analyze.TransactionMode) for call in calls)